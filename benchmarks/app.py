@@ -0,0 +1,43 @@
+from contextlib import contextmanager
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from sql_app import db_queries
+from sql_app.main import app, get_async_db, get_db, get_read_db
+
+
+@contextmanager
+def app_on_database(path: str, Session):
+    """Point every database dependency of the app at the SQLite file at `path`."""
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    AsyncSessionLocal = sessionmaker(
+        expire_on_commit=False, bind=async_engine, class_=AsyncSession)
+
+    def override_get_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    # cached movies, genres and title indexes belong to whichever database was used last
+    db_queries.movie_cache.clear()
+    db_queries.genre_cache.clear()
+    db_queries.title_trigrams.clear()
+    db_queries.title_suggestions.clear()
+    try:
+        yield app
+    finally:
+        app.dependency_overrides.clear()
+        db_queries.movie_cache.clear()
+        db_queries.genre_cache.clear()
+        db_queries.title_trigrams.clear()
+        db_queries.title_suggestions.clear()
@@ -0,0 +1,41 @@
+import json
+from urllib.parse import urlsplit
+
+
+async def request(app, method: str, url: str, body=None, headers: dict | None = None):
+    """Send one request straight to an ASGI app and return (status, headers, body)."""
+    parts = urlsplit(url)
+    payload = json.dumps(body).encode() if body is not None else b""
+    raw_headers = [(name.lower().encode(), value.encode())
+                   for name, value in (headers or {}).items()]
+    if body is not None:
+        raw_headers.append((b"content-type", b"application/json"))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": parts.path,
+        "raw_path": parts.path.encode(),
+        "query_string": parts.query.encode(),
+        "root_path": "",
+        "headers": raw_headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    messages = [{"type": "http.request", "body": payload, "more_body": False}]
+    response = {"status": None, "headers": [], "body": bytearray()}
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], bytes(response["body"])
@@ -0,0 +1,76 @@
+"""Read latency while writes are in flight.
+
+    python -m benchmarks.concurrency --rows 10000 --readers 16 --writers 4 --seconds 5
+
+Reads (GET /api/v1/movies/{id}) run alone first, then next to writers
+issuing PATCH /api/v1/movies/{id}. With the async database layer the writes
+await aiosqlite instead of blocking the event loop, so read p99 should
+stay close to the read-only run.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sql_app.main import app
+from .app import app_on_database
+from .asgi import request
+from .seed import seed_database
+
+
+def percentile(timings: list, fraction: float):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))] if timings else 0
+
+
+async def worker(method: str, rows: int, deadline: float, timings: list, errors: list, rng: random.Random):
+    while time.perf_counter() < deadline:
+        movie_id = rng.randint(1, rows)
+        if method == "GET":
+            url = f"/api/v1/movies/{movie_id}"
+        else:
+            url = f"/api/v1/movies/{movie_id}?rating={rng.randint(1, 10)}"
+        start = time.perf_counter()
+        status, _, _ = await request(app, method, url)
+        timings.append((time.perf_counter() - start) * 1000)
+        if status >= 400:
+            errors.append(status)
+
+
+async def run_phase(rows: int, readers: int, writers: int, seconds: float):
+    deadline = time.perf_counter() + seconds
+    reads, writes, errors = [], [], []
+    rng = random.Random(readers * 31 + writers)
+    await asyncio.gather(
+        *[worker("GET", rows, deadline, reads, errors, random.Random(rng.random())) for _ in range(readers)],
+        *[worker("PATCH", rows, deadline, writes, errors, random.Random(rng.random())) for _ in range(writers)],
+    )
+    print(f"readers {readers:>3} writers {writers:>3}  "
+          f"read p50 {percentile(reads, 0.5):7.2f} ms  p99 {percentile(reads, 0.99):7.2f} ms  "
+          f"reads/s {len(reads) / seconds:8.0f}  writes/s {len(writes) / seconds:6.0f}  errors {len(errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        engine, Session = seed_database(f"sqlite:///{path}", args.rows)
+        try:
+            with app_on_database(path, Session):
+                asyncio.run(run_phase(args.rows, args.readers, 0, args.seconds))
+                asyncio.run(run_phase(args.rows, args.readers,
+                            args.writers, args.seconds))
+        finally:
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Build time, memory, search latency and recall of the title trigram index.
+
+    python -m benchmarks.fuzzy_search 100000 1000000 --vocabulary zipf
+
+Every query is a seeded title with one letter dropped, the typo the fuzzy
+search is meant to forgive. With --vocabulary zipf titles are drawn from
+30000 words whose frequencies follow Zipf's law, like a real catalog; the
+default 40 words put every title in long posting lists, a worst case.
+"found" is the share of queries whose title is returned when an exhaustive
+search (no candidate bounds) returns it, "recall" the share of the
+exhaustive top 20 similarities the bounded search returns.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter
+
+from sql_app import db_queries, models
+from .seed import random_title, seed_database, zipf_title
+
+
+QUERIES = 200
+LIMIT = 20
+TITLES = {"seed": random_title, "zipf": zipf_title}
+
+
+def misspell(title: str, rng: random.Random):
+    i = rng.randrange(len(title))
+    return title[:i] + title[i + 1:]
+
+
+def run(sizes: list, vocabulary: str = "seed"):
+    rng = random.Random(7)
+    index = db_queries.title_trigrams
+    bounds = index.max_counted_postings, index.max_candidates
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            engine, Session = seed_database(
+                f"sqlite:///{os.path.join(directory, f'bench-{rows}.db')}", rows, make_title=TITLES[vocabulary])
+            db = Session()
+            try:
+                index.clear()
+                start = time.perf_counter()
+                db_queries.sync_title_trigrams(db)
+                build = time.perf_counter() - start
+                stats = index.stats()
+                ids = rng.sample(range(1, rows + 1), QUERIES)
+                titles = dict(db.query(models.Movie.id, models.Movie.title).filter(models.Movie.id.in_(ids)))
+                latencies, found, reachable, matched, expected = [], 0, 0, 0, 0
+                for movie_id in ids:
+                    q = misspell(titles[movie_id], rng)
+                    start = time.perf_counter()
+                    matches = index.search(q, limit=LIMIT)
+                    latencies.append(time.perf_counter() - start)
+                    index.max_counted_postings = index.max_candidates = None
+                    exact = index.search(q, limit=LIMIT)
+                    index.max_counted_postings, index.max_candidates = bounds
+                    if movie_id in dict(exact):
+                        reachable += 1
+                        found += movie_id in dict(matches)
+                    similarities = Counter(similarity for _, similarity in exact)
+                    matched += sum((similarities & Counter(similarity for _, similarity in matches)).values())
+                    expected += len(exact)
+                cuts = statistics.quantiles(latencies, n=20)
+                print(f"{rows:>8} titles  build {build:6.2f} s  {stats['bytes'] / 2 ** 20:7.1f} MiB  "
+                      f"{stats['trigrams']} trigrams  p50 {cuts[9] * 1e3:6.2f} ms  p95 {cuts[18] * 1e3:6.2f} ms  "
+                      f"found {found / max(reachable, 1):.2f}  recall {matched / max(expected, 1):.2f}")
+            finally:
+                db.close()
+                engine.dispose()
+                index.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", type=int, nargs="*", default=[10000, 100000])
+    parser.add_argument("--vocabulary", choices=sorted(TITLES), default="seed")
+    args = parser.parse_args()
+    run(args.sizes, args.vocabulary)
+
+
+if __name__ == "__main__":
+    main()
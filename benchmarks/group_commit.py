@@ -0,0 +1,87 @@
+"""Rating update throughput with and without group commit.
+
+    python -m benchmarks.group_commit --rows 10000 --clients 64 --seconds 5
+
+Every client sends PATCH /api/v1/movies/{id}?rating=... back to back,
+first with one transaction per request, then through a GroupCommitWriter
+that commits the updates arriving within --max-delay ms together. The
+database is in WAL mode, each commit still syncs the log.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from sql_app import main as api
+from sql_app.group_commit import GroupCommitWriter
+from .app import app_on_database
+from .asgi import request
+from .concurrency import percentile
+from .seed import seed_database
+
+
+async def client(rows: int, deadline: float, timings: list, errors: list, rng: random.Random):
+    while time.perf_counter() < deadline:
+        url = f"/api/v1/movies/{rng.randint(1, rows)}?rating={rng.randint(1, 10)}"
+        start = time.perf_counter()
+        try:
+            status, _, _ = await request(api.app, "PATCH", url)
+        except Exception:
+            # the app raises instead of answering 500, e.g. "database is locked"
+            status = 500
+        if status >= 400:
+            errors.append(status)
+        else:
+            timings.append((time.perf_counter() - start) * 1000)
+
+
+async def run_phase(name: str, rows: int, clients: int, seconds: float):
+    deadline = time.perf_counter() + seconds
+    timings, errors = [], []
+    rng = random.Random(clients)
+    await asyncio.gather(*[client(rows, deadline, timings, errors, random.Random(rng.random()))
+                           for _ in range(clients)])
+    writer = api.movie_writer
+    batch = f"  avg batch {writer.operations / writer.batches:6.1f}" if writer and writer.batches else ""
+    print(f"{name:<14} clients {clients:>4}  updates/s {len(timings) / seconds:8.0f}  "
+          f"p50 {percentile(timings, 0.5):7.2f} ms  p99 {percentile(timings, 0.99):7.2f} ms  "
+          f"errors {len(errors)}{batch}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--max-delay", type=float, default=5, help="milliseconds")
+    parser.add_argument("--max-batch", type=int, default=256)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        engine, Session = seed_database(f"sqlite:///{path}", args.rows)
+        with engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA journal_mode = WAL")
+        writer_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        original_writer = api.movie_writer
+        try:
+            with app_on_database(path, Session):
+                api.movie_writer = None
+                asyncio.run(run_phase("per request", args.rows, args.clients, args.seconds))
+                api.movie_writer = GroupCommitWriter(
+                    sessionmaker(expire_on_commit=False, bind=writer_engine, class_=AsyncSession),
+                    max_delay=args.max_delay / 1000, max_batch=args.max_batch)
+                asyncio.run(run_phase("group commit", args.rows, args.clients, args.seconds))
+        finally:
+            api.movie_writer = original_writer
+            asyncio.run(writer_engine.dispose())
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
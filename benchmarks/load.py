@@ -0,0 +1,167 @@
+"""Mixed workload load test of the whole app, per catalog size.
+
+    python -m benchmarks.load --rows 10000 100000 1000000 --concurrency 32 --seconds 10 \
+        --mix read=60,search=25,write=15 --output results.json --baseline baseline.json
+
+Each size is seeded into a fresh SQLite file and driven through the ASGI
+interface by `--concurrency` clients, each picking its next request from the
+mix. Throughput and p50/p95/p99 latency are reported per route and written to
+`--output`. With `--baseline`, routes whose p95 got slower or whose
+throughput dropped by more than `--threshold` are flagged as regressions and
+the exit status is 1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from sql_app.main import app
+from .app import app_on_database
+from .asgi import request
+from .concurrency import percentile
+from .seed import WORDS, random_title, seed_database
+
+
+def read_movie(rng: random.Random, rows: int):
+    return "GET /api/v1/movies/{id}", "GET", f"/api/v1/movies/{rng.randint(1, rows)}", None
+
+
+def list_movies(rng: random.Random, rows: int):
+    return "GET /api/v1/movies/?sort", "GET", f"/api/v1/movies/?sort={rng.choice(['-rating', 'year', 'title'])}&limit=20", None
+
+
+def search_movies(rng: random.Random, rows: int):
+    return "GET /api/v1/movies/?q", "GET", f"/api/v1/movies/?q={rng.choice(WORDS)}&limit=20", None
+
+
+def patch_movie(rng: random.Random, rows: int):
+    return "PATCH /api/v1/movies/{id}", "PATCH", f"/api/v1/movies/{rng.randint(1, rows)}?rating={rng.randint(1, 10)}", None
+
+
+def create_movie(rng: random.Random, rows: int):
+    movie = {"title": random_title(rng), "year": rng.randint(1920, 2022),
+             "rating": rng.randint(0, 10), "genre_id": rng.randint(1, 19)}
+    return "POST /api/v1/movies/", "POST", "/api/v1/movies/", movie
+
+
+WORKLOADS = {
+    "read": [read_movie, list_movies],
+    "search": [search_movies],
+    "write": [patch_movie, create_movie],
+}
+
+
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in WORKLOADS:
+            raise argparse.ArgumentTypeError(
+                f"Unknown workload {name}, use {', '.join(WORKLOADS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+async def client(rows: int, mix: dict, deadline: float, timings: dict, errors: dict, rng: random.Random):
+    workloads, weights = list(mix), list(mix.values())
+    while time.perf_counter() < deadline:
+        workload = rng.choice(WORKLOADS[rng.choices(workloads, weights)[0]])
+        route, method, url, body = workload(rng, rows)
+        start = time.perf_counter()
+        status, _, _ = await request(app, method, url, body)
+        timings.setdefault(route, []).append((time.perf_counter() - start) * 1000)
+        # a duplicate title from the random generator is an expected answer
+        if status >= 500 or (status >= 400 and status != 409):
+            errors[route] = errors.get(route, 0) + 1
+
+
+async def run_load(rows: int, concurrency: int, mix: dict, seconds: float, seed: int):
+    timings, errors = {}, {}
+    rng = random.Random(seed)
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*[client(rows, mix, deadline, timings, errors, random.Random(rng.random()))
+                           for _ in range(concurrency)])
+    return {
+        route: {
+            "requests": len(route_timings),
+            "errors": errors.get(route, 0),
+            "throughput": len(route_timings) / seconds,
+            "p50_ms": percentile(route_timings, 0.5),
+            "p95_ms": percentile(route_timings, 0.95),
+            "p99_ms": percentile(route_timings, 0.99),
+        }
+        for route, route_timings in sorted(timings.items())
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    regressions = []
+    for rows, routes in results["runs"].items():
+        for route, stats in routes.items():
+            before = baseline.get("runs", {}).get(rows, {}).get(route)
+            if not before:
+                continue
+            if stats["p95_ms"] > before["p95_ms"] * (1 + threshold):
+                regressions.append(
+                    f"{rows} rows {route}: p95 {before['p95_ms']:.2f} -> {stats['p95_ms']:.2f} ms")
+            if stats["throughput"] < before["throughput"] * (1 - threshold):
+                regressions.append(
+                    f"{rows} rows {route}: throughput {before['throughput']:.0f} -> {stats['throughput']:.0f} req/s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the app on seeded databases")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--mix", type=parse_mix, default="read=60,search=25,write=15")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative p95 or throughput change reported as a regression")
+    args = parser.parse_args(argv)
+
+    results = {
+        "concurrency": args.concurrency,
+        "seconds": args.seconds,
+        "mix": args.mix,
+        "python": platform.python_version(),
+        "runs": {},
+    }
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.db")
+            engine, Session = seed_database(f"sqlite:///{path}", rows, args.seed)
+            try:
+                with app_on_database(path, Session):
+                    routes = asyncio.run(run_load(
+                        rows, args.concurrency, args.mix, args.seconds, args.seed))
+            finally:
+                engine.dispose()
+        results["runs"][str(rows)] = routes
+        print(f"{rows} rows")
+        for route, stats in routes.items():
+            print(f"  {route:<28} {stats['throughput']:8.0f} req/s  p50 {stats['p50_ms']:7.2f}  "
+                  f"p95 {stats['p95_ms']:7.2f}  p99 {stats['p99_ms']:7.2f} ms  errors {stats['errors']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
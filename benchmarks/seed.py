@@ -0,0 +1,80 @@
+import random
+from itertools import accumulate
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from sql_app import models
+from sql_app.database import Base
+
+
+WORDS = [
+    "star", "wars", "night", "dark", "knight", "lord", "rings", "godfather", "return", "king",
+    "lost", "city", "love", "story", "house", "dead", "blood", "ghost", "space", "time",
+    "war", "world", "last", "man", "woman", "girl", "boy", "river", "fire", "ice",
+    "secret", "garden", "shadow", "empire", "strikes", "back", "matrix", "alien", "island", "moon",
+]
+SEED_BATCH = 10000
+
+
+def random_title(rng: random.Random):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+
+
+def _vocabulary(size: int):
+    # a few English function words, then made up words in random order
+    rng = random.Random(0)
+    onsets = "b c d f g h j k l m n p r s t v w y z bl br ch cl cr dr fl fr gl gr kn pl pr sc sh sl sp st sw th tr wh".split()
+    vowels = "a e i o u a e i o u ai ay ea ee ie oa oo ou ow".split()
+    codas = "- - - b ck d ft g k l ld ll m n nd ng nk nt p r rd rk rn rt s ss st t th x".split()
+    middles = "- - - - - - - l n r".split()
+    words = ["the", "of", "a", "and", "in", "to", "my", "on"]
+    seen = set(words)
+    while len(words) < size:
+        syllables = rng.choice([1, 2, 2, 2, 3])
+        word = "".join(rng.choice(onsets) + rng.choice(vowels) + rng.choice(codas if i == syllables - 1 else middles)
+                       for i in range(syllables)).replace("-", "")
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+# a catalog-like vocabulary whose word frequencies follow Zipf's law, so a
+# few words are in many titles and most are rare
+VOCABULARY = _vocabulary(30000)
+VOCABULARY_WEIGHTS = list(accumulate(1 / rank for rank in range(1, len(VOCABULARY) + 1)))
+
+
+def zipf_title(rng: random.Random):
+    return " ".join(rng.choices(VOCABULARY, cum_weights=VOCABULARY_WEIGHTS, k=rng.randint(1, 4))).title()
+
+
+def seed_database(url: str, rows: int, seed: int = 42, make_title=random_title):
+    engine = sa.create_engine(url, connect_args={"check_same_thread": False})
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(seed)
+    # (normalized title, year) is unique among active movies
+    taken = set()
+
+    def random_movie():
+        while True:
+            title, year = make_title(rng), rng.randint(1920, 2022)
+            if (title.casefold(), year) not in taken:
+                taken.add((title.casefold(), year))
+                return {
+                    "title": title,
+                    "normalized_title": models.normalize_title(title),
+                    "rating": round(rng.uniform(0, 10), 1),
+                    "year": year,
+                    "genre_id": rng.randint(1, 19),
+                    "is_active": True,
+                }
+
+    with engine.begin() as connection:
+        connection.execute(models.Genre.__table__.insert(), [
+            {"name": f"Genre {i}", "is_active": True} for i in range(1, 20)])
+        for start in range(0, rows, SEED_BATCH):
+            connection.execute(models.Movie.__table__.insert(), [
+                random_movie() for _ in range(min(SEED_BATCH, rows - start))])
+    return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -0,0 +1,65 @@
+"""Per-row cost of a movie list response, before and after the row fast path.
+
+    python -m benchmarks.serialization 100 1000 10000
+
+"orm" loads Movie instances, validates each through schemas.Movie in
+orm_mode and encodes them with jsonable_encoder and JSONResponse, which is
+what response_model=list[schemas.Movie] did. "rows" selects the columns as
+rows and encodes the dicts with ORJSONResponse, as GET /api/v1/movies/ does now.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from sql_app import db_queries, models, schemas
+from .seed import seed_database
+
+
+REPEAT = 20
+
+
+def orm_response(db, limit: int):
+    db_movies = db.query(models.Movie).filter(
+        models.Movie.is_active).order_by(models.Movie.id).limit(limit).all()
+    return JSONResponse(jsonable_encoder([schemas.Movie.from_orm(movie) for movie in db_movies])).body
+
+
+def rows_response(db, limit: int):
+    db_movies = db_queries.get_movies(db, limit=limit)
+    return ORJSONResponse([row._asdict() for row in db_movies]).body
+
+
+def measure(render, Session, limit: int):
+    best = float("inf")
+    for _ in range(REPEAT):
+        # a fresh session each time so the ORM path pays for hydration
+        db = Session()
+        try:
+            start = time.perf_counter()
+            render(db, limit)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            db.close()
+    return best
+
+
+def run(limits: list):
+    with tempfile.TemporaryDirectory() as directory:
+        engine, Session = seed_database(
+            f"sqlite:///{os.path.join(directory, 'bench.db')}", max(limits))
+        try:
+            for limit in limits:
+                before = measure(orm_response, Session, limit)
+                after = measure(rows_response, Session, limit)
+                print(f"{limit:>7} rows  orm {before * 1e6 / limit:7.2f} us/row  "
+                      f"rows {after * 1e6 / limit:7.2f} us/row  {before / after:5.1f}x")
+        finally:
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000])
@@ -0,0 +1,53 @@
+"""Build time, memory and lookup latency of the autocomplete title index.
+
+    python -m benchmarks.suggest 100000 1000000
+
+Every lookup is the start of a seeded title cut after a random number of
+characters, like the requests of a search box typing it.
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from sql_app import db_queries
+from .seed import random_title, seed_database
+
+
+LOOKUPS = 2000
+
+
+def run(sizes: list):
+    rng = random.Random(7)
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            engine, Session = seed_database(
+                f"sqlite:///{os.path.join(directory, f'bench-{rows}.db')}", rows)
+            db = Session()
+            try:
+                db_queries.title_suggestions.clear()
+                start = time.perf_counter()
+                db_queries.sync_title_suggestions(db)
+                build = time.perf_counter() - start
+                stats = db_queries.title_suggestions.stats()
+                latencies = []
+                for _ in range(LOOKUPS):
+                    title = random_title(rng)
+                    prefix = title[:rng.randint(1, len(title))]
+                    start = time.perf_counter()
+                    db_queries.title_suggestions.suggest(prefix)
+                    latencies.append(time.perf_counter() - start)
+                cuts = statistics.quantiles(latencies, n=100)
+                print(f"{rows:>8} titles  build {build:6.2f} s  {stats['bytes'] / 2 ** 20:7.1f} MiB  "
+                      f"{stats['cached_prefixes']} cached prefixes  "
+                      f"p50 {cuts[49] * 1e3:6.3f} ms  p99 {cuts[98] * 1e3:6.3f} ms")
+            finally:
+                db.close()
+                engine.dispose()
+                db_queries.title_suggestions.clear()
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,48 @@
+"""Compare the FTS5 title index against the ilike substring scan.
+
+    python -m benchmarks.title_search 10000 100000 1000000
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from sql_app import db_queries
+from .seed import WORDS, seed_database
+
+
+QUERIES = 200
+
+
+def measure(search, db, queries):
+    timings = []
+    for q in queries:
+        start = time.perf_counter()
+        search(db, q=q, limit=100)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95)]
+
+
+def run(rows: int):
+    with tempfile.TemporaryDirectory() as directory:
+        engine, Session = seed_database(
+            f"sqlite:///{os.path.join(directory, 'bench.db')}", rows)
+        rng = random.Random(rows)
+        queries = [" ".join(rng.sample(WORDS, rng.randint(1, 2)))
+                   for _ in range(QUERIES)]
+        db = Session()
+        try:
+            for name, search in (("ilike", db_queries.get_movies_by_substring), ("fts5", db_queries.get_movies_by_query)):
+                p50, p95 = measure(search, db, queries)
+                print(f"{rows:>9} rows  {name:<6} p50 {p50:8.2f} ms  p95 {p95:8.2f} ms")
+        finally:
+            db.close()
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    for rows in [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]:
+        run(rows)
@@ -0,0 +1,29 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import db_queries, schemas
+
+
+# Each query runs the synchronous implementation from db_queries on the
+# AsyncSession's greenlet, so both layers share one set of write paths.
+
+async def create_movie(db: AsyncSession, movie: schemas.MovieBase):
+    return await db.run_sync(db_queries.create_movie, movie)
+
+
+async def upsert_movie(db: AsyncSession, movie: schemas.MovieBase):
+    return await db.run_sync(db_queries.upsert_movie, movie)
+
+
+async def update_movie_complete(db: AsyncSession, movie_id: int, movie: schemas.MovieBase):
+    return await db.run_sync(db_queries.update_movie_complete, movie_id, movie)
+
+
+async def update_movie_partial(db: AsyncSession, movie_id: int, movie: schemas.MovieBase):
+    return await db.run_sync(db_queries.update_movie_partial, movie_id, movie)
+
+
+async def delete_movie(db: AsyncSession, movie_id: int):
+    return await db.run_sync(db_queries.delete_movie, movie_id)
+
+
+async def get_movie_by_id(db: AsyncSession, movie_id: int):
+    return await db.run_sync(db_queries.get_movie_by_id, movie_id)
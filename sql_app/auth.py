@@ -1,8 +1,15 @@
 from fastapi import Depends, HTTPException
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import os
+import threading
+import time
 from . import schemas
-from starlette.status import HTTP_401_UNAUTHORIZED
+from .cache import LRUCache
+from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_503_SERVICE_UNAVAILABLE
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestFormStrict
 from jose import JWTError, jwt
 
@@ -13,6 +20,22 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 120
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/token")
 
+# bcrypt takes ~250ms of CPU, it runs on a small pool and logins beyond
+# PASSWORD_HASH_MAX_PENDING are turned away instead of queueing without bound
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(
+    os.environ.get("PASSWORD_HASH_MAX_PENDING", "16"))
+password_hash_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+pending_password_hashes = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+
+# verified tokens, keyed by their sha256 digest and never kept past their exp
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", "60"))
+token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+optional_oauth2_scheme = OAuth2PasswordBearer(
+    tokenUrl="/api/v1/token", auto_error=False)
+
 fake_users_db = {
     "admin": {
         "username": "admin",
@@ -47,6 +70,28 @@ def authenticate_user(fake_db, username: str, password: str):
     return user
 
 
+async def verify_password_async(plain_password, hashed_password):
+    if not pending_password_hashes.acquire(blocking=False):
+        raise HTTPException(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many concurrent logins, retry later",
+            headers={"Retry-After": "1"},
+        )
+    future = password_hash_executor.submit(
+        verify_password, plain_password, hashed_password)
+    future.add_done_callback(lambda _: pending_password_hashes.release())
+    return await asyncio.wrap_future(future)
+
+
+async def authenticate_user_async(fake_db, username: str, password: str):
+    user = get_user(fake_db, username)
+    if not user:
+        return False
+    if not await verify_password_async(password, user.hashed_password):
+        return False
+    return user
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -64,6 +109,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    user = token_cache.get(digest)
+    if user is not None:
+        return user
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -75,6 +124,9 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     user = get_user(fake_users_db, username=token_data.username)
     if user is None:
         raise credentials_exception
+    if "exp" in payload:
+        token_cache.set(digest, user, ttl=min(
+            TOKEN_CACHE_TTL, payload["exp"] - time.time()))
     return user
 
 
@@ -82,3 +134,9 @@ async def get_current_active_user(current_user: schemas.User = Depends(get_curre
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
+
+
+async def get_optional_active_user(token: str | None = Depends(optional_oauth2_scheme)):
+    if token is None:
+        return None
+    return await get_current_active_user(await get_current_user(token))
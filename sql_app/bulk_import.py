@@ -0,0 +1,212 @@
+"""Streaming bulk import of movie dumps.
+
+    python -m sql_app.bulk_import movies.tsv --batch-size 5000 --rejects rejects.tsv
+
+Rows are read lazily from CSV, TSV or JSONL files, validated against
+schemas.MovieBase and written with one executemany insert and one commit
+per batch. IMDb style columns (primaryTitle, startYear, averageRating,
+genres) are accepted next to the API field names.
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+import sqlalchemy as sa
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import models, schemas
+from .database import SQLALCHEMY_DATABASE_URL
+
+
+COLUMN_ALIASES = {
+    "primaryTitle": "title",
+    "startYear": "year",
+    "averageRating": "rating",
+    "genres": "genre",
+}
+# durability is traded for speed while loading, a failed import is simply re-run
+LOAD_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "temp_store": "MEMORY",
+    "cache_size": "-262144",
+}
+MAX_REPORTED_REJECTIONS = 1000
+MAX_BATCH_SIZE = 50000
+
+
+class MalformedFileError(ValueError):
+    pass
+
+
+def read_rows(stream, format: str):
+    # a file that can not be decoded or parsed stops the import, the
+    # batches before it stay committed
+    try:
+        yield from _read_rows(stream, format)
+    except (UnicodeDecodeError, csv.Error) as error:
+        raise MalformedFileError(f"Malformed {format} file: {error}") from error
+
+
+def _read_rows(stream, format: str):
+    if format == "jsonl":
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
+        return
+    if format == "tsv":
+        reader = csv.DictReader(stream, delimiter="\t", quoting=csv.QUOTE_NONE)
+    else:
+        reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _normalize_row(row: dict, genre_ids: dict):
+    movie = {}
+    for key, value in row.items():
+        if key is None:
+            continue
+        movie[COLUMN_ALIASES.get(key, key)] = None if value in ("", "\\N") else value
+    genre = movie.pop("genre", None)
+    if movie.get("genre_id") is None and isinstance(genre, str):
+        movie["genre_id"] = genre_ids.get(genre.split(",")[0].strip().casefold())
+    return movie
+
+
+def validate_rows(rows, genre_ids: dict):
+    known_ids = set(genre_ids.values())
+    for line_number, row in rows:
+        if row is None:
+            yield line_number, None, "Malformed row"
+            continue
+        try:
+            movie = schemas.MovieBase(**_normalize_row(row, genre_ids))
+        except ValidationError as error:
+            yield line_number, None, "; ".join(
+                f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+            continue
+        if movie.rating is not None and (movie.rating < 0 or movie.rating > 10):
+            yield line_number, None, "Rating must be between 0 and 10"
+        elif movie.genre_id not in known_ids:
+            yield line_number, None, f"Unknown genre_id {movie.genre_id}"
+        else:
+            yield line_number, movie, None
+
+
+def _insert_batch(db: Session, batch: list, reject):
+    # earlier batches are already committed, so checking the batch against
+    # itself and the database is enough to catch every duplicate
+    seen = set()
+    existing = set(db.query(models.Movie.normalized_title, models.Movie.year).filter(
+        models.Movie.is_active, models.Movie.normalized_title.in_(
+            {models.normalize_title(movie.title) for _, movie, _ in batch if movie})))
+    rows = []
+    for line_number, movie, reason in batch:
+        if movie:
+            key = (models.normalize_title(movie.title), movie.year)
+            if key in seen or key in existing:
+                reason = "Movie already added"
+            seen.add(key)
+        if reason:
+            reject(line_number, reason)
+            continue
+        rows.append((line_number, {**movie.dict(), "normalized_title": key[0], "is_active": True}))
+    if not rows:
+        return 0
+    try:
+        db.execute(models.Movie.__table__.insert(), [row for _, row in rows])
+        db.commit()
+        return len(rows)
+    except IntegrityError:
+        db.rollback()
+    # another writer added one of the movies since the check, the rows
+    # are inserted one by one to find it
+    inserted = 0
+    for line_number, row in rows:
+        try:
+            db.execute(models.Movie.__table__.insert(), row)
+            db.commit()
+            inserted += 1
+        except IntegrityError:
+            db.rollback()
+            reject(line_number, "Movie already added")
+    return inserted
+
+
+def import_movies(db: Session, rows, batch_size: int = 5000, on_reject=None):
+    report = schemas.ImportReport()
+    started = time.perf_counter()
+
+    def reject(line_number: int, reason: str):
+        report.rejected += 1
+        if len(report.rejections) < MAX_REPORTED_REJECTIONS:
+            report.rejections.append(schemas.ImportRejection(
+                line=line_number, reason=reason))
+        if on_reject:
+            on_reject(line_number, reason)
+
+    genre_ids = {genre.name.casefold(): genre.id for genre in db.query(
+        models.Genre).filter(models.Genre.is_active)}
+    validated = validate_rows(rows, genre_ids)
+    while batch := list(islice(validated, batch_size)):
+        report.inserted += _insert_batch(db, batch, reject)
+    report.seconds = time.perf_counter() - started
+    report.rows_per_second = (
+        report.inserted + report.rejected) / report.seconds if report.seconds else 0
+    return report
+
+
+def create_load_session(url: str = SQLALCHEMY_DATABASE_URL):
+    engine = sa.create_engine(url)
+
+    @sa.event.listens_for(engine, "connect")
+    def set_load_pragmas(dbapi_connection, connection_record):
+        for name, value in LOAD_PRAGMAS.items():
+            dbapi_connection.execute(f"PRAGMA {name} = {value}")
+
+    models.Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import a movie dump")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "tsv", "jsonl"])
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--database-url", default=SQLALCHEMY_DATABASE_URL)
+    parser.add_argument("--rejects", help="write rejected lines and reasons to this file")
+    args = parser.parse_args(argv)
+    format = args.format or args.path.rsplit(".", 1)[-1].lower()
+    if format not in ("csv", "tsv", "jsonl"):
+        parser.error(f"Cannot guess the format of {args.path}, use --format")
+    if not 1 <= args.batch_size <= MAX_BATCH_SIZE:
+        parser.error(f"--batch-size must be between 1 and {MAX_BATCH_SIZE}")
+
+    rejects = open(args.rejects, "w", encoding="utf-8") if args.rejects else None
+    db = create_load_session(args.database_url)
+    try:
+        with open(args.path, encoding="utf-8", newline="") as stream:
+            report = import_movies(db, read_rows(stream, format), args.batch_size,
+                                   on_reject=(lambda line, reason: rejects.write(f"{line}\t{reason}\n")) if rejects else None)
+    finally:
+        db.close()
+        if rejects:
+            rejects.close()
+    print(f"inserted {report.inserted} rejected {report.rejected} in {report.seconds:.1f}s "
+          f"({report.rows_per_second:.0f} rows/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
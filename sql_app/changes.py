@@ -0,0 +1,72 @@
+import threading
+
+from sqlalchemy import event, func, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import models
+
+
+# a reader further behind than this drops its caches instead of replaying
+MAX_CHANGES = 1000
+
+
+class ChangeFeed:
+    """Reads the change_log table so the caches of one worker learn about
+    writes made by any other.
+
+    `sync` runs before every cached read. It first asks the connection for
+    PRAGMA data_version, which only changes when another connection has
+    committed since this one last asked, and reads the new change_log rows
+    only then. Each pooled connection remembers the data_version it saw in
+    its `info`, and the feed was up to date at that moment, so an unchanged
+    value means there is nothing new to read. A connection's own commits do
+    not change its data_version, so committing forgets it.
+    """
+
+    def __init__(self, apply, drop):
+        # apply([(table_name, row_id)]) invalidates the changed entries,
+        # drop() clears every cache when the changes can not be replayed
+        self.apply = apply
+        self.drop = drop
+        self.last_id = None
+        self._lock = threading.Lock()
+
+    def sync(self, db: Session):
+        connection = db.connection()
+        info = connection.connection.info
+        with self._lock:
+            data_version = connection.exec_driver_sql("PRAGMA data_version").scalar()
+            if self.last_id is not None and info.get("data_version") == data_version:
+                return
+            if self.last_id is None:
+                # nothing was cached before the first sync
+                self.last_id = db.query(func.max(models.ChangeLog.id)).scalar() or 0
+            else:
+                changes = db.query(models.ChangeLog.id, models.ChangeLog.table_name, models.ChangeLog.row_id).filter(
+                    models.ChangeLog.id > self.last_id).order_by(models.ChangeLog.id).limit(MAX_CHANGES + 1).all()
+                # ids are never reused, a gap means the rows were pruned before this worker read them
+                if len(changes) > MAX_CHANGES or (changes and changes[0].id != self.last_id + 1):
+                    self.drop()
+                    self.last_id = db.query(func.max(models.ChangeLog.id)).scalar() or 0
+                elif changes:
+                    self.apply([(change.table_name, change.row_id) for change in changes])
+                    self.last_id = changes[-1].id
+            info["data_version"] = data_version
+
+    def reset(self):
+        with self._lock:
+            self.last_id = None
+
+
+@event.listens_for(Engine, "commit")
+def _forget_data_version(connection):
+    connection.connection.info.pop("data_version", None)
+
+
+def prune_change_log(db: Session, keep: int):
+    # Keeps the newest `keep` changes, workers further behind drop their
+    # caches. The newest one always stays, it is how they notice the gap.
+    db.execute(text("DELETE FROM change_log WHERE id <= (SELECT max(id) FROM change_log) - :keep"),
+               {"keep": max(keep, 1)})
+    db.commit()
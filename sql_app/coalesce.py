@@ -0,0 +1,98 @@
+import asyncio
+import os
+from urllib.parse import parse_qsl
+
+from starlette.routing import Match
+
+from .metrics import coalesced_requests
+
+
+# longest a request waits for an identical one in flight before running itself
+COALESCE_MAX_WAIT = float(os.environ.get("COALESCE_MAX_WAIT", "2"))
+
+
+class _Flight:
+    def __init__(self):
+        # the leader's response messages, None when it failed
+        self.response = asyncio.get_running_loop().create_future()
+
+
+class CoalescingMiddleware:
+    """Single-flight for identical concurrent GET requests.
+
+    The first request for a key (route, sorted query parameters and
+    If-None-Match) runs, identical requests arriving meanwhile wait for its
+    response and replay it instead of opening their own session. Only the
+    routes in `paths`, which answer from the database alone, are coalesced.
+    A follower gives up after `max_wait` seconds and runs itself. When the
+    leader fails or answers with a server error, its followers start over
+    and one of them leads the next attempt.
+    """
+
+    def __init__(self, app, router, paths: set, max_wait: float = COALESCE_MAX_WAIT):
+        self.app = app
+        self.router = router
+        self.paths = paths
+        self.max_wait = max_wait
+        self._flights = {}
+
+    def match(self, scope):
+        # the router picks the first full match, routes declared before a
+        # path template (e.g. /movies/export before /movies/{movie_id}) win
+        for route in self.router.routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                return route, child_scope
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        route, child_scope = self.match(scope)
+        if route is None or route.path not in self.paths:
+            return await self.app(scope, receive, send)
+        # lets the outer middlewares label the request even when the router never sees it
+        scope.update(child_scope)
+        headers = dict(scope["headers"])
+        key = (scope["path"], tuple(sorted(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))),
+               headers.get(b"if-none-match"))
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while True:
+            flight = self._flights.get(key)
+            if flight is None:
+                return await self._lead(key, scope, receive, send)
+            try:
+                response = await asyncio.wait_for(
+                    asyncio.shield(flight.response), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                coalesced_requests.child(route.path, "timeout").inc()
+                return await self.app(scope, receive, send)
+            if response is None:
+                coalesced_requests.child(route.path, "leader_failed").inc()
+                continue
+            coalesced_requests.child(route.path, "shared").inc()
+            for message in response:
+                await send(message)
+            return
+
+    async def _lead(self, key, scope, receive, send):
+        flight = self._flights[key] = _Flight()
+        messages = []
+
+        async def capture(message):
+            messages.append(message)
+
+        response = None
+        try:
+            await self.app(scope, receive, capture)
+            if messages and messages[0]["status"] < 500:
+                response = messages
+        finally:
+            del self._flights[key]
+            flight.response.set_result(response)
+        # the response is shared before it is sent, a slow client only
+        # holds up itself
+        for message in messages:
+            await send(message)
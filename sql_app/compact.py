@@ -0,0 +1,111 @@
+"""Archiving of soft deleted movies.
+
+    python -m sql_app.compact --retention-days 30
+
+Movies soft deleted longer than the retention window ago are moved from
+`movies` to `movies_archive` in batches of their own short transaction,
+then the freed pages are given back with incremental vacuum. The change
+log is trimmed to its newest CHANGE_LOG_KEEP entries. The API runs the
+same job every ARCHIVE_INTERVAL seconds, and trims the change log every
+CHANGE_LOG_PRUNE_INTERVAL seconds even when archiving is off.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+from starlette.concurrency import run_in_threadpool
+
+from . import changes, db_queries, models
+from .database import SQLALCHEMY_DATABASE_URL
+
+
+ARCHIVE_RETENTION_DAYS = float(os.environ.get("ARCHIVE_RETENTION_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "1000"))
+# seconds between two runs in the API, 0 turns the job off
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "3600"))
+CHANGE_LOG_KEEP = int(os.environ.get("CHANGE_LOG_KEEP", "100000"))
+# seconds between two trims of the change log in the API, 0 turns them off
+CHANGE_LOG_PRUNE_INTERVAL = float(os.environ.get("CHANGE_LOG_PRUNE_INTERVAL", "300"))
+# pause between batches so queued writers get the lock
+BATCH_PAUSE = 0.05
+
+logger = logging.getLogger("api_logger")
+
+
+def compact(db, retention_days: float = ARCHIVE_RETENTION_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE,
+            pause: float = BATCH_PAUSE):
+    """Returns the number of movies archived and of pages freed, None when
+    the database is not in incremental auto_vacuum mode."""
+    older_than = datetime.utcnow() - timedelta(days=retention_days)
+    archived = 0
+    for moved in db_queries.archive_deleted_movies(db, older_than, batch_size):
+        archived += moved
+        time.sleep(pause)
+    changes.prune_change_log(db, CHANGE_LOG_KEEP)
+    return archived, db_queries.vacuum_free_pages(db)
+
+
+async def compact_periodically(Session, interval: float = ARCHIVE_INTERVAL):
+    def run():
+        db = Session()
+        try:
+            return compact(db)
+        finally:
+            db.close()
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            archived, freed = await run_in_threadpool(run)
+            logger.info("Archived %s deleted movies, freed %s pages", archived, freed)
+        except Exception:
+            logger.exception("Archiving deleted movies failed")
+
+
+async def prune_change_log_periodically(Session, interval: float = CHANGE_LOG_PRUNE_INTERVAL,
+                                        keep: int = CHANGE_LOG_KEEP):
+    def run():
+        db = Session()
+        try:
+            changes.prune_change_log(db, keep)
+        finally:
+            db.close()
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(run)
+        except Exception:
+            logger.exception("Trimming the change log failed")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive soft deleted movies and vacuum free pages")
+    parser.add_argument("--retention-days", type=float, default=ARCHIVE_RETENTION_DAYS)
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--database-url", default=SQLALCHEMY_DATABASE_URL)
+    args = parser.parse_args(argv)
+
+    engine = sa.create_engine(args.database_url)
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    try:
+        archived, freed = compact(db, args.retention_days, args.batch_size)
+    finally:
+        db.close()
+    print(f"{archived} deleted movies archived")
+    if freed is None:
+        print("auto_vacuum is not INCREMENTAL, run VACUUM once after setting it to reclaim space")
+    else:
+        print(f"{freed} free pages vacuumed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,132 @@
-from sqlalchemy import create_engine
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+SQLALCHEMY_DATABASE_URL = os.environ.get(
+    "DATABASE_URL", "sqlite:///./sql_app.db")
+ASYNC_SQLALCHEMY_DATABASE_URL = os.environ.get(
+    "ASYNC_DATABASE_URL", SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_ECHO = os.environ.get("DB_ECHO", "false").lower() == "true"
+SQLITE_PRAGMAS = {
+    # only takes effect on a new database, see db_queries.vacuum_free_pages
+    "auto_vacuum": os.environ.get("SQLITE_AUTO_VACUUM", "INCREMENTAL"),
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "cache_size": os.environ.get("SQLITE_CACHE_SIZE", "-65536"),
+    "busy_timeout": os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"),
+}
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+
+# checkout wait per pool, keyed by the pool's logging name
+pool_wait_stats = {}
+
+
+class TimedCheckoutMixin:
+    # SQLAlchemy has no "before checkout" pool event, so the wait is timed
+    # around the pool's own connection acquisition
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait_stats.setdefault(self.logging_name, PoolWaitStats()).observe(
+                time.perf_counter() - start)
+
+
+class TimedQueuePool(TimedCheckoutMixin, QueuePool):
+    pass
 
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+class TimedAsyncQueuePool(TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _set_sqlite_pragmas(engine, pragmas: dict):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def _engine_options(url: str, name: str, poolclass):
+    options = {
+        "echo": DB_ECHO,
+        "poolclass": poolclass,
+        "pool_logging_name": name,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, echo=False
+    SQLALCHEMY_DATABASE_URL, **_engine_options(SQLALCHEMY_DATABASE_URL, "write", TimedQueuePool)
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# GET handlers read through their own pool of query_only connections, so in
+# WAL mode they never wait behind writers for a connection or for the lock
+read_engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, **_engine_options(SQLALCHEMY_DATABASE_URL, "read", TimedQueuePool)
+)
+ReadSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, bind=read_engine)
+
+# aiosqlite runs every statement on its own thread, so awaiting it never blocks the event loop
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL, **_engine_options(ASYNC_SQLALCHEMY_DATABASE_URL, "async", TimedAsyncQueuePool))
+AsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession)
+
+if engine.dialect.name == "sqlite":
+    _set_sqlite_pragmas(engine, SQLITE_PRAGMAS)
+    _set_sqlite_pragmas(read_engine, {**SQLITE_PRAGMAS, "query_only": "ON"})
+    _set_sqlite_pragmas(async_engine.sync_engine, SQLITE_PRAGMAS)
+
+
+def pool_stats():
+    stats = {}
+    for name, pool in (("write", engine.pool), ("read", read_engine.pool), ("async", async_engine.sync_engine.pool)):
+        wait = pool_wait_stats.get(name, PoolWaitStats())
+        stats[name] = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "checkouts": wait.checkouts,
+            "wait_seconds": wait.wait_seconds,
+            "max_wait_seconds": wait.max_wait_seconds,
+        }
+    return stats
+
+
 Base = declarative_base()
@@ -1,20 +1,107 @@
+import os
+import re
+from sqlalchemy import Float, func, literal_column, or_, select, text, type_coerce
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from . import models, schemas
+from .cache import LRUCache
+from .changes import ChangeFeed
+from .suggest import SuggestIndex
+from .trigram import TrigramIndex
+
+
+MOVIE_CACHE_SIZE = int(os.environ.get("MOVIE_CACHE_SIZE", "10000"))
+MOVIE_CACHE_TTL = float(os.environ.get("MOVIE_CACHE_TTL", "60"))
+GENRE_CACHE_TTL = float(os.environ.get("GENRE_CACHE_TTL", "300"))
+
+movie_cache = LRUCache(maxsize=MOVIE_CACHE_SIZE, ttl=MOVIE_CACHE_TTL)
+genre_cache = LRUCache(maxsize=1, ttl=GENRE_CACHE_TTL)
+title_trigrams = TrigramIndex()
+title_suggestions = SuggestIndex()
+
+
+def movies_written(*movie_ids: int):
+    # called after every commit that creates, updates or deletes movies
+    movie_cache.invalidate(*movie_ids)
+
+
+def _apply_changes(changes: list):
+    movie_ids = [row_id for table_name, row_id in changes if table_name == "movies"]
+    if movie_ids:
+        movie_cache.invalidate(*movie_ids)
+    if any(table_name == "genres" for table_name, _ in changes):
+        genre_cache.clear()
+
+
+def _drop_caches():
+    movie_cache.clear()
+    genre_cache.clear()
+
+
+# writes made by other workers reach the caches through the change log
+change_feed = ChangeFeed(apply=_apply_changes, drop=_drop_caches)
+
+
+class DuplicateMovieError(Exception):
+    pass
+
+
+def _commit_unique(db: Session):
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise DuplicateMovieError()
 
 
 def create_movie(db: Session, movie: schemas.MovieBase):
-    db_movie = models.Movie(
+    # the unique (normalized_title, year) index does the duplicate check,
+    # a duplicate inserts nothing and returns None
+    result = db.execute(insert(models.Movie).values(
         title=movie.title,
+        normalized_title=models.normalize_title(movie.title),
         rating=movie.rating,
         year=movie.year,
-        genre_id=movie.genre_id
-    )
-    db.add(db_movie)
+        genre_id=movie.genre_id,
+        is_active=True
+    ).on_conflict_do_nothing(index_elements=models.movie_identity, index_where=models.movie_identity_where))
     db.commit()
-    db.refresh(db_movie)
+    if not result.rowcount:
+        return None
+    db_movie = db.get(models.Movie, result.inserted_primary_key[0])
+    movies_written(db_movie.id)
     return db_movie
 
 
+def get_movie_by_identity(db: Session, title: str, year: int):
+    return db.query(models.Movie).filter(
+        models.Movie.normalized_title == models.normalize_title(title),
+        models.Movie.year == year, models.Movie.is_active).first()
+
+
+UPSERT_ATTEMPTS = 3
+
+
+def upsert_movie(db: Session, movie: schemas.MovieBase):
+    # the movie that blocked the insert can be deleted or archived before it
+    # is read back, the insert is then tried again
+    for _ in range(UPSERT_ATTEMPTS):
+        db_movie = create_movie(db, movie)
+        if db_movie:
+            return db_movie, True
+        db_movie = get_movie_by_identity(db, movie.title, movie.year)
+        if db_movie:
+            db_movie.title = movie.title
+            db_movie.rating = movie.rating
+            db_movie.genre_id = movie.genre_id
+            _commit_unique(db)
+            db.refresh(db_movie)
+            movies_written(db_movie.id)
+            return db_movie, False
+    raise DuplicateMovieError()
+
+
 def update_movie_complete(db: Session, movie_id: int, movie: schemas.MovieBase):
     db_movie = db.query(models.Movie).filter(
         models.Movie.id == movie_id, models.Movie.is_active).first()
@@ -23,8 +110,9 @@ def update_movie_complete(db: Session, movie_id: int, movie: schemas.MovieBase):
         db_movie.rating = movie.rating
         db_movie.year = movie.year
         db_movie.genre_id = movie.genre_id
-        db.commit()
+        _commit_unique(db)
         db.refresh(db_movie)
+        movies_written(movie_id)
         return db_movie
     return None
 
@@ -41,8 +129,9 @@ def update_movie_partial(db: Session, movie_id: int, movie: schemas.MovieBase):
             db_movie.year = movie.year
         if movie.genre_id:
             db_movie.genre_id = movie.genre_id
-        db.commit()
+        _commit_unique(db)
         db.refresh(db_movie)
+        movies_written(movie_id)
         return db_movie
     return None
 
@@ -54,20 +143,514 @@ def delete_movie(db: Session, movie_id: int):
         db_movie.is_active = False
         db.commit()
         db.refresh(db_movie)
+        movies_written(movie_id)
         return db_movie
     return None
 
 
+BATCH_ATTEMPTS = 3
+
+
+def apply_movie_batch(db: Session, operations: list[schemas.MovieBatchOperation], allow_delete: bool):
+    # a movie added by another request between the identity check and the
+    # commit breaks the unique index, the batch is then checked again and
+    # gets a 409 for the operations that collide with it
+    for _ in range(BATCH_ATTEMPTS):
+        try:
+            return _apply_movie_batch(db, operations, allow_delete)
+        except IntegrityError:
+            db.rollback()
+    raise DuplicateMovieError()
+
+
+def _apply_movie_batch(db: Session, operations: list[schemas.MovieBatchOperation], allow_delete: bool):
+    ids = {operation.id for operation in operations if operation.id is not None}
+    db_movies = {db_movie.id: db_movie for db_movie in db.query(models.Movie).filter(
+        models.Movie.id.in_(ids), models.Movie.is_active)} if ids else {}
+    # a change of year alone can collide too, so the targets' own titles are looked up
+    titles = {models.normalize_title(operation.movie.title) for operation in operations
+              if operation.movie and operation.movie.title} | {
+        db_movie.normalized_title for db_movie in db_movies.values()}
+    # identities of the active movies the batch could collide with, kept up
+    # to date as the batch creates, renames and deletes movies
+    taken = {(title, year): movie_id for title, year, movie_id in db.query(
+        models.Movie.normalized_title, models.Movie.year, models.Movie.id).filter(
+        models.Movie.normalized_title.in_(titles), models.Movie.is_active)} if titles else {}
+
+    results = []
+    for operation in operations:
+        movie = operation.movie or schemas.MoviePatch()
+        db_movie = db_movies.get(operation.id)
+        if movie.rating is not None and (movie.rating < 0 or movie.rating > 10):
+            results.append((400, "Rating must be between 0 and 10", None))
+        elif operation.op == "create":
+            identity = (models.normalize_title(movie.title), movie.year)
+            if movie.title is None or movie.year is None or movie.genre_id is None:
+                results.append(
+                    (422, "title, year and genre_id are required", None))
+            elif identity in taken:
+                results.append((409, "Movie already added", None))
+            else:
+                taken[identity] = None
+                db_movie = models.Movie(**movie.dict())
+                db.add(db_movie)
+                results.append((201, None, db_movie))
+        elif operation.op == "delete" and not allow_delete:
+            results.append((401, "Not authenticated", None))
+        elif not db_movie:
+            results.append(
+                (404, f"Missing movie with id {operation.id}", None))
+        elif operation.op == "update" and (movie.title is None or movie.year is None or movie.genre_id is None):
+            results.append(
+                (422, "title, year and genre_id are required", None))
+        elif operation.op == "delete":
+            taken.pop((db_movie.normalized_title, db_movie.year), None)
+            db_movie.is_active = False
+            results.append((200, None, db_movie))
+        else:
+            changes = movie.dict(exclude_none=operation.op == "patch")
+            identity = (models.normalize_title(changes.get("title", db_movie.title)),
+                        changes.get("year", db_movie.year))
+            if taken.get(identity, db_movie.id) != db_movie.id:
+                results.append((409, "Movie already added", None))
+                continue
+            taken.pop((db_movie.normalized_title, db_movie.year), None)
+            taken[identity] = db_movie.id
+            for field, value in changes.items():
+                setattr(db_movie, field, value)
+            results.append((200, None, db_movie))
+    db.flush()
+    results = [schemas.MovieBatchResult(status=status, detail=detail, movie=db_movie and schemas.Movie.from_orm(db_movie))
+               for status, detail, db_movie in results]
+    db.commit()
+    movies_written(*(result.movie.id for result in results if result.movie))
+    return results
+
+
 def get_movie_by_id(db: Session, movie_id: int):
     return db.query(models.Movie).filter(models.Movie.id == movie_id, models.Movie.is_active).first()
 
 
-def get_movies(db: Session, limit: int = 100):
-    return db.query(models.Movie).filter(models.Movie.is_active).limit(limit).all()
+def get_movie_by_id_cached(db: Session, movie_id: int):
+    change_feed.sync(db)
+    cached = movie_cache.get(movie_id)
+    if cached is None:
+        generation = movie_cache.generation
+        db_movie = get_movie_by_id(db, movie_id)
+        if db_movie is None:
+            return None
+        cached = (schemas.Movie.from_orm(db_movie), db_movie.version)
+        movie_cache.set(movie_id, cached, generation=generation)
+    return cached[0]
+
+
+def get_movie_version(db: Session, movie_id: int):
+    change_feed.sync(db)
+    cached = movie_cache.get(movie_id)
+    if cached is not None:
+        return cached[1]
+    return db.query(models.Movie.version).filter(
+        models.Movie.id == movie_id, models.Movie.is_active).scalar()
+
+
+def get_table_version(db: Session, name: str):
+    return db.query(models.TableVersion.version).filter(
+        models.TableVersion.name == name).scalar() or 0
+
+
+SORT_COLUMNS = {
+    "id": models.Movie.id,
+    "rating": models.movie_rating_key,
+    "year": models.Movie.year,
+    "title": models.Movie.title,
+}
+
+
+# List queries select these columns as plain rows instead of hydrating Movie
+# instances. The rating is read as the float SQLite stores, not a Decimal.
+MOVIE_ROW = (
+    models.Movie.id,
+    models.Movie.title,
+    models.Movie.year,
+    type_coerce(models.Movie.rating, Float).label("rating"),
+    models.Movie.genre_id,
+)
+
+
+def export_movies(db: Session, updated_since=None, batch_size: int = 1000):
+    # Full exports stream the active movies in id order. Incremental exports
+    # stream every movie changed since `updated_since` in the order they
+    # changed, soft deleted ones included so consumers can drop them.
+    query = db.query(*MOVIE_ROW, models.Movie.is_active, models.Movie.updated_at)
+    if updated_since is None:
+        query = query.filter(models.Movie.is_active).order_by(models.Movie.id)
+    else:
+        query = query.filter(models.Movie.updated_at >= updated_since).order_by(
+            models.Movie.updated_at, models.Movie.id)
+    return query.yield_per(batch_size)
+
+
+def _search_rank():
+    return func.bm25(literal_column("movies_fts"))
+
+
+def _sort_column(sort: str):
+    name = sort.removeprefix("-")
+    if name not in SORT_COLUMNS:
+        raise ValueError(f"Unsupported sort {sort}")
+    return SORT_COLUMNS[name], sort.startswith("-")
+
+
+def _filter_movies(query, filters: schemas.MovieFilter | None):
+    if filters is None:
+        return query
+    if filters.genre_id is not None:
+        query = query.filter(models.Movie.genre_id == filters.genre_id)
+    if filters.year_min is not None:
+        query = query.filter(models.Movie.year >= filters.year_min)
+    if filters.year_max is not None:
+        query = query.filter(models.Movie.year <= filters.year_max)
+    # rating ranges go through the indexed rating key, a lower bound of 0
+    # keeps unrated movies (keyed -1) out of any rating range
+    if filters.rating_min is not None or filters.rating_max is not None:
+        query = query.filter(models.movie_rating_key >= (
+            filters.rating_min if filters.rating_min is not None else 0))
+    if filters.rating_max is not None:
+        query = query.filter(models.movie_rating_key <= filters.rating_max)
+    return query
+
+
+def _order_and_seek(query, key, descending: bool, after: tuple | None):
+    # keyset pagination: order by (key, id) and skip every row up to `after`
+    id_column = models.Movie.id
+    if descending:
+        query = query.order_by(key.desc(), id_column.desc())
+    else:
+        query = query.order_by(key, id_column)
+    if after is None:
+        return query
+    value, last_id = after
+    if key is id_column:
+        return query.filter(id_column < last_id if descending else id_column > last_id)
+    # the redundant bound on `key` lets SQLite turn the seek into an index range
+    if descending:
+        return query.filter(key <= value, or_(key < value, id_column < last_id))
+    return query.filter(key >= value, or_(key > value, id_column > last_id))
+
+
+def movies_query(db: Session, sort: str = "id", after: tuple | None = None, filters: schemas.MovieFilter | None = None):
+    key, descending = _sort_column(sort)
+    query = _filter_movies(db.query(*MOVIE_ROW).filter(models.Movie.is_active), filters)
+    return _order_and_seek(query, key, descending, after)
+
+
+def get_movies(db: Session, limit: int = 100, sort: str = "id", after: tuple | None = None, filters: schemas.MovieFilter | None = None):
+    return movies_query(db, sort, after, filters).limit(limit).all()
+
+
+def get_movies_by_substring(db: Session, q: str, limit: int = 100, sort: str = "id", after: tuple | None = None, filters: schemas.MovieFilter | None = None):
+    key, descending = _sort_column(sort)
+    query = _filter_movies(db.query(*MOVIE_ROW).filter(
+        models.Movie.title.ilike(f"%{q}%"), models.Movie.is_active), filters)
+    return _order_and_seek(query, key, descending, after).limit(limit).all()
+
+
+def title_match_expression(q: str):
+    # every word of the query must match the start of a word in the title
+    return " ".join(f'"{term}"*' for term in re.findall(r"\w+", q))
+
 
+def _match_title(query, match: str):
+    return query.join(models.movies_fts, models.movies_fts.c.rowid == models.Movie.id).filter(
+        models.movies_fts.c.title.match(match))
 
-def get_movies_by_query(db: Session, q: str, limit: int = 100):
-    return db.query(models.Movie).filter(models.Movie.title.ilike(f"%{q}%"), models.Movie.is_active).limit(limit).all()
+
+def get_movies_by_query(db: Session, q: str, limit: int = 100, sort: str = "relevance", after: tuple | None = None, filters: schemas.MovieFilter | None = None):
+    match = title_match_expression(q)
+    if not match:
+        return get_movies_by_substring(db, q=q, limit=limit, sort="id" if sort == "relevance" else sort, after=after, filters=filters)
+    if sort == "relevance":
+        key, descending = _search_rank(), False
+    else:
+        key, descending = _sort_column(sort)
+    query = _filter_movies(_match_title(db.query(*MOVIE_ROW).select_from(models.Movie), match).filter(
+        models.Movie.is_active), filters)
+    return _order_and_seek(query, key, descending, after).limit(limit).all()
+
+
+FUZZY_THRESHOLD = 0.3
+# filters are applied to the candidates of the index, so it returns extra ones
+FUZZY_OVERFETCH = 4
+
+
+def _sync_title_index(db: Session, index, columns: tuple):
+    # Every write to movies moves updated_at forward (see models.VERSION_DDL),
+    # so the index catches up with the rows changed since the newest one it
+    # applied, whichever process wrote them. The first call builds it whole.
+    # One thread at a time reads and applies, otherwise one reading an older
+    # snapshot could apply a stale row after synced_at moved past it.
+    with index.sync_lock:
+        if index.synced_at is None:
+            latest = db.query(func.max(models.Movie.updated_at)).scalar()
+            index.build(db.query(models.Movie.id, *columns).filter(
+                models.Movie.is_active).order_by(models.Movie.id))
+            index.synced_at = latest
+            return
+        for movie_id, *values, is_active, updated_at in db.query(
+                models.Movie.id, *columns, models.Movie.is_active, models.Movie.updated_at).filter(
+                models.Movie.updated_at >= index.synced_at):
+            if is_active:
+                index.add(movie_id, *values)
+            else:
+                index.remove(movie_id)
+            index.synced_at = max(index.synced_at, updated_at)
+
+
+def sync_title_trigrams(db: Session):
+    _sync_title_index(db, title_trigrams, (models.Movie.title,))
+
+
+def get_movies_by_similarity(db: Session, q: str, limit: int = 100, filters: schemas.MovieFilter | None = None):
+    sync_title_trigrams(db)
+    matches = title_trigrams.search(
+        q, limit=limit and limit * FUZZY_OVERFETCH, threshold=FUZZY_THRESHOLD)
+    if not matches:
+        return []
+    rows = {row.id: row for row in _filter_movies(db.query(*MOVIE_ROW).filter(
+        models.Movie.id.in_([movie_id for movie_id, _ in matches]), models.Movie.is_active), filters)}
+    # most similar first, ties by id
+    return [rows[movie_id] for movie_id, _ in matches if movie_id in rows][:limit]
+
+
+def sync_title_suggestions(db: Session):
+    _sync_title_index(db, title_suggestions, (
+        models.Movie.title, models.Movie.year, type_coerce(models.Movie.rating, Float)))
+
+
+def get_title_suggestions(db: Session, prefix: str, limit: int = 10):
+    sync_title_suggestions(db)
+    return title_suggestions.suggest(prefix, limit=limit)
+
+
+FACETS = ("genre", "decade")
+
+
+def get_movie_facets(db: Session, facets: set[str], q: str | None = None, filters: schemas.MovieFilter | None = None):
+    # Counts per (genre, decade) come from one grouped query and are rolled up
+    # into each facet. Without a search or a rating range they are read from
+    # the movie_stats summary table, so their cost does not grow with the
+    # catalog; otherwise the matching movies are grouped in the same index
+    # or FTS pass that finds them.
+    filters = filters or schemas.MovieFilter()
+    if not q and filters.rating_min is None and filters.rating_max is None:
+        stat = models.MovieStat
+        query = db.query(stat.genre_id, stat.year / 10 * 10, func.sum(stat.count))
+        if filters.genre_id is not None:
+            query = query.filter(stat.genre_id == filters.genre_id)
+        if filters.year_min is not None:
+            query = query.filter(stat.year >= filters.year_min)
+        if filters.year_max is not None:
+            query = query.filter(stat.year <= filters.year_max)
+    else:
+        query = db.query(models.Movie.genre_id, models.Movie.year / 10 * 10, func.count()).select_from(
+            models.Movie).filter(models.Movie.is_active)
+        match = title_match_expression(q or "")
+        if match:
+            query = _match_title(query, match)
+        elif q:
+            query = query.filter(models.Movie.title.ilike(f"%{q}%"))
+        query = _filter_movies(query, filters)
+
+    genres, decades = {}, {}
+    for genre_id, decade, count in query.group_by(literal_column("1"), literal_column("2")):
+        genres[genre_id] = genres.get(genre_id, 0) + count
+        decades[decade] = decades.get(decade, 0) + count
+    result = {}
+    if "genre" in facets:
+        names = {genre.id: genre.name for genre in get_genres_cached(db)}
+        result["genre"] = [schemas.FacetCount(value=genre_id, name=names.get(genre_id), count=count)
+                           for genre_id, count in sorted(genres.items(), key=lambda item: (-item[1], item[0]))]
+    if "decade" in facets:
+        result["decade"] = [schemas.FacetCount(value=decade, count=count)
+                            for decade, count in sorted(decades.items())]
+    return result
+
+
+def get_sort_key(db: Session, movie: models.Movie, sort: str, q: str | None = None):
+    name = sort.removeprefix("-")
+    if name == "relevance":
+        match = title_match_expression(q or "")
+        if not match:
+            return movie.id, movie.id
+        rank = db.query(_search_rank()).select_from(models.movies_fts).filter(
+            models.movies_fts.c.title.match(match), models.movies_fts.c.rowid == movie.id).scalar()
+        return rank, movie.id
+    if name == "rating":
+        return (float(movie.rating) if movie.rating is not None else -1), movie.id
+    return getattr(movie, name), movie.id
+
+
+class SchemaUpgradeError(Exception):
+    pass
+
+
+def ensure_movie_columns(db: Session):
+    # create_all skips existing tables, so a database created by an older
+    # release gets the new columns of `movies` and their indexes here
+    columns = {row.name for row in db.execute(text("PRAGMA table_info(movies)"))}
+    for name, column_type in models.MOVIE_ADDED_COLUMNS.items():
+        if name not in columns:
+            db.execute(text(f"ALTER TABLE movies ADD COLUMN {name} {column_type}"))
+    # Python's casefold has no SQL equivalent, older rows are normalized here
+    rows = db.execute(text(
+        "SELECT id, title FROM movies WHERE normalized_title IS NULL AND title IS NOT NULL")).all()
+    if rows:
+        db.execute(text("UPDATE movies SET normalized_title = :normalized_title WHERE id = :id"),
+                   [{"id": movie_id, "normalized_title": models.normalize_title(title)} for movie_id, title in rows])
+    db.execute(text(f"UPDATE movies SET updated_at = {models.SQLITE_NOW} WHERE updated_at = :upgraded"),
+               {"upgraded": models.UPGRADED_UPDATED_AT})
+    db.commit()
+    duplicates = db.execute(text(
+        """SELECT normalized_title, year, group_concat(id, ', ') FROM movies
+        WHERE is_active AND normalized_title IS NOT NULL AND year IS NOT NULL
+        GROUP BY normalized_title, year HAVING count(*) > 1""")).all()
+    if duplicates:
+        raise SchemaUpgradeError(
+            "Active movies share a title and year, soft delete all but one of each: " + "; ".join(
+                f"{title!r} {year} (ids {ids})" for title, year, ids in duplicates))
+    for name in models.MOVIE_DROPPED_INDEXES:
+        db.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    # checkfirst reflection skips expression indexes, sqlite_master has them all
+    indexes = {name for name, in db.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    for index in models.Movie.__table__.indexes:
+        if index.name not in indexes:
+            index.create(db.connection())
+    db.commit()
+
+
+def ensure_title_index(db: Session):
+    exists = db.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE name = 'movies_fts'")).first()
+    for statement in models.MOVIES_FTS_DDL:
+        db.execute(text(statement))
+    if not exists:
+        db.execute(text(
+            "INSERT INTO movies_fts(rowid, title) SELECT id, title FROM movies WHERE is_active"))
+    db.commit()
+
+
+def ensure_movie_stats(db: Session):
+    exists = db.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE name = 'movie_stats_ai'")).first()
+    for statement in models.MOVIE_STATS_DDL:
+        db.execute(text(statement))
+    if not exists:
+        rebuild_movie_stats(db)
+    db.commit()
+
+
+def rebuild_movie_stats(db: Session):
+    db.execute(text("DELETE FROM movie_stats"))
+    db.execute(text(
+        f"INSERT INTO movie_stats(genre_id, year, bucket, count, rating_sum) {models.MOVIE_STATS_SELECT}"))
+    db.commit()
+
+
+def check_movie_stats(db: Session):
+    # returns the (genre_id, year, bucket) keys whose stored aggregate differs
+    # from one computed over `movies`
+    expected = {tuple(row[:3]): tuple(row[3:])
+                for row in db.execute(text(models.MOVIE_STATS_SELECT))}
+    stored = {(row.genre_id, row.year, row.bucket): (row.count, row.rating_sum)
+              for row in db.query(models.MovieStat)}
+    return sorted(key for key in expected.keys() | stored.keys()
+                  if key not in expected or key not in stored
+                  or expected[key][0] != stored[key][0]
+                  or abs(expected[key][1] - stored[key][1]) > 1e-6)
+
+
+STATS_GROUPS = {
+    "genres": models.MovieStat.genre_id,
+    "years": models.MovieStat.year,
+}
+
+
+def get_movie_stats(db: Session, group: str):
+    column = STATS_GROUPS[group]
+    stats = {}
+    for key, bucket, count, rating_sum in db.query(
+            column, models.MovieStat.bucket, func.sum(models.MovieStat.count),
+            func.sum(models.MovieStat.rating_sum)).group_by(column, models.MovieStat.bucket).order_by(column):
+        entry = stats.setdefault(key, {"key": key, "count": 0, "rated": 0, "rating_sum": 0.0,
+                                       "histogram": [0] * 11})
+        entry["count"] += count
+        if bucket >= 0:
+            entry["rated"] += count
+            entry["rating_sum"] += rating_sum
+            entry["histogram"][bucket] += count
+    return [schemas.MovieStats(
+        key=entry["key"], count=entry["count"], rated=entry["rated"], histogram=entry["histogram"],
+        average_rating=round(entry["rating_sum"] / entry["rated"], 2) if entry["rated"] else None)
+        for entry in stats.values()]
+
+
+ARCHIVED_COLUMNS = ("id", "title", "normalized_title", "rating", "year", "genre_id", "version", "updated_at")
+
+
+def archive_deleted_movies(db: Session, older_than, batch_size: int = 1000):
+    # Moves movies soft deleted before `older_than` to movies_archive, one
+    # short transaction per batch so writers never wait long for the lock.
+    # Yields the number of movies moved by each batch.
+    movie = models.Movie
+    # the newest movie is never moved: SQLite gives a new row the highest id
+    # plus one, so an archived id can not be handed out again
+    deleted = (movie.is_active == False, movie.updated_at < older_than,  # noqa: E712
+               movie.id < select(func.max(movie.id)).scalar_subquery())
+    while True:
+        movie_ids = [movie_id for movie_id, in db.query(movie.id).filter(*deleted).order_by(
+            movie.updated_at).limit(batch_size)]
+        if not movie_ids:
+            return
+        # the conditions are checked again inside the write transaction, a
+        # movie restored or moved meanwhile is left alone
+        batch = (movie.id.in_(movie_ids), *deleted)
+        db.execute(insert(models.ArchivedMovie).from_select(
+            ARCHIVED_COLUMNS, select(*(getattr(movie, name) for name in ARCHIVED_COLUMNS)).where(*batch)))
+        moved = db.query(movie).filter(*batch).delete(synchronize_session=False)
+        db.commit()
+        movies_written(*movie_ids)
+        yield moved
+
+
+def vacuum_free_pages(db: Session, pages: int = 1000):
+    # Returns the free pages given back to the file system, `pages` per
+    # statement, or None when the database is not in incremental auto_vacuum
+    # mode (it only changes on a new database or after a full VACUUM).
+    if db.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+        return None
+    db.commit()
+    free = before = db.execute(text("PRAGMA freelist_count")).scalar()
+    while free:
+        # the pragma yields an empty row per page freed and the sqlite3
+        # module stops at the first one, executescript runs it to the end
+        db.connection().connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        free = db.execute(text("PRAGMA freelist_count")).scalar()
+    db.commit()
+    return before
+
+
+def ensure_change_log(db: Session):
+    for statements in models.CHANGE_LOG_DDL.values():
+        for statement in statements:
+            db.execute(text(statement))
+    db.commit()
+
+
+def ensure_version_tracking(db: Session):
+    for statements in models.VERSION_DDL.values():
+        for statement in statements:
+            db.execute(text(statement))
+    db.commit()
 
 
 def populate_genres(db: Session):
@@ -94,7 +677,31 @@ def populate_genres(db: Session):
             models.Genre(name='Western')
         ])
         db.commit()
+        genre_cache.clear()
 
 
 def get_genres(db: Session):
     return db.query(models.Genre).filter(models.Genre.is_active).all()
+
+
+def get_genres_cached(db: Session):
+    return _get_cached_genres(db)[0]
+
+
+def get_genres_version(db: Session):
+    return _get_cached_genres(db)[1]
+
+
+def _get_cached_genres(db: Session):
+    change_feed.sync(db)
+    cached = genre_cache.get("genres")
+    if cached is None:
+        generation = genre_cache.generation
+        # the genres and their table version are read in one query
+        version = db.query(models.TableVersion.version).filter(
+            models.TableVersion.name == "genres").scalar_subquery()
+        rows = db.query(models.Genre, version).filter(models.Genre.is_active).all()
+        cached = ([schemas.Genre.from_orm(genre) for genre, _ in rows],
+                  (rows[0][1] or 0) if rows else get_table_version(db, "genres"))
+        genre_cache.set("genres", cached, generation=generation)
+    return cached
@@ -0,0 +1,64 @@
+"""Streaming encoders for GET /api/v1/movies/export.
+
+Rows are pulled from the query BATCH_SIZE at a time and each batch is
+encoded into one chunk, so a response holds a single batch in memory
+whatever the size of the catalog.
+"""
+import csv
+import io
+import zlib
+from itertools import islice
+
+import orjson
+
+
+BATCH_SIZE = 1000
+FIELDS = ("id", "title", "year", "rating", "genre_id", "is_active", "updated_at")
+
+
+def _batches(rows):
+    rows = iter(rows)
+    while batch := list(islice(rows, BATCH_SIZE)):
+        yield batch
+
+
+def encode_rows(rows, format: str):
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(FIELDS)
+        for batch in _batches(rows):
+            writer.writerows(batch)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+    else:
+        for batch in _batches(rows):
+            yield b"".join(orjson.dumps(row._asdict()) + b"\n" for row in batch)
+
+
+def accepts_gzip(accept_encoding: str):
+    # gzip is named explicitly or covered by "*", either way with a q above 0
+    weights = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+    return weights.get("gzip", weights.get("x-gzip", weights.get("*", 0.0))) > 0
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,104 @@
+import asyncio
+import os
+
+from . import db_queries, schemas
+
+
+GROUP_COMMIT = os.environ.get("GROUP_COMMIT", "false").lower() == "true"
+# how long the first update of a batch waits for others, in seconds
+GROUP_COMMIT_MAX_DELAY = float(os.environ.get("GROUP_COMMIT_MAX_DELAY", "0.005"))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("GROUP_COMMIT_MAX_BATCH", "256"))
+
+
+class GroupCommitWriter:
+    """Applies concurrent movie patches in one transaction.
+
+    `submit` queues a patch and waits for its own result. The first patch
+    of a batch schedules a flush after `max_delay`, a batch reaching
+    `max_batch` is flushed at once. A batch is applied by
+    db_queries.apply_movie_batch, so it costs one read of the movies, one
+    commit and one fsync, and each patch still gets its own status (404,
+    409, ...). Batches commit one at a time while the next one fills. A
+    batch that breaks the unique index as a whole is applied again one
+    patch at a time, the colliding one gets a 409 like the unbatched path.
+    Any other error fails every request of the batch.
+    """
+
+    def __init__(self, Session, max_delay: float = GROUP_COMMIT_MAX_DELAY, max_batch: int = GROUP_COMMIT_MAX_BATCH):
+        self.Session = Session
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.operations = 0
+        self._loop = None
+
+    def _bind(self, loop):
+        # futures, timers and the lock belong to one event loop
+        self._loop = loop
+        self._pending = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    async def submit(self, operation: schemas.MovieBatchOperation) -> schemas.MovieBatchResult:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._bind(loop)
+        future = loop.create_future()
+        self._pending.append((operation, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = self._loop.create_task(self._commit(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _commit(self, batch: list):
+        async with self._lock:
+            try:
+                results = await self._apply([operation for operation, _ in batch])
+            except db_queries.DuplicateMovieError:
+                # a movie written outside the batch since it read the
+                # identities, only the patch that collides with it fails
+                for operation, future in batch:
+                    try:
+                        result = (await self._apply([operation]))[0]
+                    except db_queries.DuplicateMovieError:
+                        result = schemas.MovieBatchResult(status=409, detail="Movie already added")
+                    except Exception as error:
+                        _resolve(future, error=error)
+                        continue
+                    _resolve(future, result)
+                return
+            except Exception as error:
+                for _, future in batch:
+                    _resolve(future, error=error)
+                return
+            for (_, future), result in zip(batch, results):
+                _resolve(future, result)
+
+    async def _apply(self, operations: list):
+        async with self.Session() as db:
+            results = await db.run_sync(db_queries.apply_movie_batch, operations, False)
+        self.batches += 1
+        self.operations += len(operations)
+        return results
+
+
+def _resolve(future, result=None, error=None):
+    # the request behind a future may have been cancelled (client gone)
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
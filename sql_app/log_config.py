@@ -1,6 +1,15 @@
+import os
 from os.path import abspath, dirname, join
 base_dir = abspath(dirname(__file__))
-logs_target_api = join(base_dir + "\\logs", "request_logs.log")
+logs_target_api = os.environ.get("LOG_FILE", join(base_dir, "logs", "request_logs.log"))
+
+# request logging, see request_logging.RequestLoggingMiddleware
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1.0"))
+LOG_MAX_BODY_BYTES = int(os.environ.get("LOG_MAX_BODY_BYTES", "4096"))
+LOG_REDACT_HEADERS = os.environ.get(
+    "LOG_REDACT_HEADERS", "authorization,cookie,set-cookie").split(",")
+LOG_REDACT_BODY_FIELDS = os.environ.get(
+    "LOG_REDACT_BODY_FIELDS", "password,client_secret,access_token").split(",")
 
 
 logging_schema_api = {
@@ -16,6 +25,12 @@ logging_schema_api = {
             "format": "%(asctime)s\t%(levelname)s\t%(filename)s\t%(message)s",
             # Optional: asctime format
             "datefmt": "%d %b %y %H:%M:%S"
+        },
+        # One JSON object per line, with request headers and bodies redacted
+        "json": {
+            "()": "sql_app.request_logging.JsonFormatter",
+            "redact_headers": LOG_REDACT_HEADERS,
+            "redact_body_fields": LOG_REDACT_BODY_FIELDS,
         }
     },
     # Handlers use the formatter names declared above
@@ -33,9 +48,10 @@ logging_schema_api = {
         },
         # Same as the StreamHandler example above, but with different
         # handler-specific kwargs.
+        # Written by a background QueueListener, see request_logging.move_handlers_to_queue
         "file": {
             "class": "logging.handlers.RotatingFileHandler",
-            "formatter": "standard",
+            "formatter": "json",
             "level": "INFO",
             "filename": logs_target_api,
             "mode": "a",
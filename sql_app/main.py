@@ -1,14 +1,19 @@
-from fastapi import Depends, FastAPI, HTTPException, Response, Request
-from starlette.status import HTTP_204_NO_CONTENT, HTTP_202_ACCEPTED, HTTP_201_CREATED, HTTP_200_OK, HTTP_401_UNAUTHORIZED
+from fastapi import Depends, FastAPI, File, HTTPException, Query, Response, Request, UploadFile
+from starlette.status import HTTP_304_NOT_MODIFIED, HTTP_204_NO_CONTENT, HTTP_202_ACCEPTED, HTTP_201_CREATED, HTTP_200_OK, HTTP_401_UNAUTHORIZED
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sql_app.auth import ACCESS_TOKEN_EXPIRE_MINUTES, authenticate_user, create_access_token, get_current_active_user, fake_users_db
-from . import db_queries, models, schemas
-from .database import SessionLocal, engine
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from sql_app.auth import ACCESS_TOKEN_EXPIRE_MINUTES, authenticate_user_async, create_access_token, get_current_active_user, get_optional_active_user, fake_users_db, token_cache
+from . import async_db_queries, bulk_import, coalesce, compact, db_queries, export, group_commit, metrics, models, pagination, schemas
+from .database import AsyncSessionLocal, ReadSessionLocal, SessionLocal, async_engine, engine, pool_stats, read_engine
 from logging.config import dictConfig
 import logging
-from .log_config import logging_schema_api
+from .log_config import LOG_MAX_BODY_BYTES, LOG_SAMPLE_RATE, logging_schema_api
+from .request_logging import RequestLoggingMiddleware, move_handlers_to_queue
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestFormStrict
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
+import asyncio
+import io
 
 import uvicorn
 
@@ -20,17 +25,77 @@ if __name__ == "__main__":
 
 models.Base.metadata.create_all(bind=engine)
 dictConfig(logging_schema_api)
+move_handlers_to_queue(logging.getLogger())
 logger = logging.getLogger("api_logger")
+# identical concurrent reads of these routes share one execution
+COALESCED_PATHS = {
+    "/api/v1/movies/",
+    "/api/v1/movies/suggest",
+    "/api/v1/movies/{movie_id}",
+    "/api/v1/genres/",
+    "/api/v1/stats/{group}",
+}
+app.add_middleware(coalesce.CoalescingMiddleware, router=app.router, paths=COALESCED_PATHS)
+app.add_middleware(RequestLoggingMiddleware, logger=logging.getLogger("api_logger.requests"),
+                   sample_rate=LOG_SAMPLE_RATE, max_body_bytes=LOG_MAX_BODY_BYTES)
+app.add_middleware(metrics.MetricsMiddleware, router=app.router)
+metrics.instrument_engine(engine, "write")
+metrics.instrument_engine(read_engine, "read")
+metrics.instrument_engine(async_engine.sync_engine, "async")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/token")
+# with GROUP_COMMIT=true concurrent PATCHes share one transaction
+movie_writer = group_commit.GroupCommitWriter(AsyncSessionLocal) if group_commit.GROUP_COMMIT else None
 
 
 @app.on_event("startup")
 def startup_event():
     db = SessionLocal()
+    db_queries.ensure_movie_columns(db)
     db_queries.populate_genres(db)
+    db_queries.ensure_title_index(db)
+    db_queries.ensure_version_tracking(db)
+    db_queries.ensure_change_log(db)
+    db_queries.ensure_movie_stats(db)
+    db_queries.sync_title_trigrams(db)
+    db_queries.sync_title_suggestions(db)
     db.close()
 
 
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    app.state.loop_lag_monitor = asyncio.create_task(
+        metrics.monitor_event_loop_lag())
+
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    app.state.loop_lag_monitor.cancel()
+
+
+@app.on_event("startup")
+async def start_compaction():
+    app.state.compaction = asyncio.create_task(
+        compact.compact_periodically(SessionLocal)) if compact.ARCHIVE_INTERVAL > 0 else None
+
+
+@app.on_event("shutdown")
+async def stop_compaction():
+    if app.state.compaction is not None:
+        app.state.compaction.cancel()
+
+
+@app.on_event("startup")
+async def start_change_log_pruning():
+    app.state.change_log_pruning = asyncio.create_task(
+        compact.prune_change_log_periodically(SessionLocal)) if compact.CHANGE_LOG_PRUNE_INTERVAL > 0 else None
+
+
+@app.on_event("shutdown")
+async def stop_change_log_pruning():
+    if app.state.change_log_pruning is not None:
+        app.state.change_log_pruning.cancel()
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -44,105 +109,304 @@ def get_db():
         db.close()
 
 
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        logger.error("Could not connect to database", exc_info=True)
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error - Could not connect to database")
+    finally:
+        db.close()
+
+
+EXPANSIONS = ("genre",)
+
+
+def parse_expand(expand: str | None = None):
+    expand = {name.strip() for name in expand.split(",") if name.strip()} if expand else set()
+    if not expand <= set(EXPANSIONS):
+        raise HTTPException(
+            status_code=400, detail=f"Expand must be among {', '.join(EXPANSIONS)}")
+    return expand
+
+
+def not_modified(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+async def get_async_db():
+    db = AsyncSessionLocal()
+    try:
+        yield db
+    except Exception:
+        await db.rollback()
+        logger.error("Could not connect to database", exc_info=True)
+        raise HTTPException(
+            status_code=500, detail="Internal Server Error - Could not connect to database")
+    finally:
+        await db.close()
+
+
 @app.post("/api/v1/movies/", status_code=HTTP_202_ACCEPTED, response_model=schemas.Movie)
-async def create_movie(movie: schemas.MovieBase, response: Response, request: Request, db: Session = Depends(get_db)):
-    logger.info(
-        f"{request.method} {request.url} {request.headers} {await request.json()}")
-    db_movies = db_queries.get_movies_by_query(db, q=movie.title)
-    # movies can have the same name or the same year, but not both
-    for db_movie in db_movies:
-        if db_movie and db_movie.year == movie.year:
-            raise HTTPException(status_code=409, detail="Movie already added")
-    if movie.rating < 0 or movie.rating > 10:
+async def create_movie(movie: schemas.MovieBase, response: Response, upsert: bool = False, db: AsyncSession = Depends(get_async_db)):
+    if movie.rating is not None and (movie.rating < 0 or movie.rating > 10):
         raise HTTPException(
             status_code=400, detail="Rating must be between 0 and 10")
+    # movies can have the same name or the same year, but not both
+    if upsert:
+        try:
+            db_movie, created = await async_db_queries.upsert_movie(db=db, movie=movie)
+        except db_queries.DuplicateMovieError:
+            raise HTTPException(status_code=409, detail="Movie already added")
+        response.status_code = HTTP_201_CREATED if created else HTTP_200_OK
+        return db_movie
+    db_movie = await async_db_queries.create_movie(db=db, movie=movie)
+    if not db_movie:
+        raise HTTPException(status_code=409, detail="Movie already added")
     response.status_code = HTTP_201_CREATED
-    return db_queries.create_movie(db=db, movie=movie)
+    return db_movie
+
+
+@app.post("/api/v1/movies/import", status_code=HTTP_200_OK, response_model=schemas.ImportReport)
+def import_movies(file: UploadFile = File(...), format: str | None = None, batch_size: int = Query(5000, ge=1, le=bulk_import.MAX_BATCH_SIZE), db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_active_user)):
+    format = format or (file.filename or "").rsplit(".", 1)[-1].lower()
+    if format not in ("csv", "tsv", "jsonl"):
+        raise HTTPException(
+            status_code=400, detail="Format must be csv, tsv or jsonl")
+    stream = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+    try:
+        return bulk_import.import_movies(db, bulk_import.read_rows(stream, format), batch_size)
+    except bulk_import.MalformedFileError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+
+MAX_BATCH_OPERATIONS = 1000
+
+
+@app.post("/api/v1/movies:batch", status_code=HTTP_200_OK, response_model=list[schemas.MovieBatchResult])
+def batch_movies(operations: list[schemas.MovieBatchOperation], db: Session = Depends(get_db), current_user: schemas.User | None = Depends(get_optional_active_user)):
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(
+            status_code=400, detail=f"A batch can have at most {MAX_BATCH_OPERATIONS} operations")
+    try:
+        return db_queries.apply_movie_batch(db, operations, allow_delete=current_user is not None)
+    except db_queries.DuplicateMovieError:
+        raise HTTPException(status_code=409, detail="Movie already added")
 
 
 @app.put("/api/v1/movies/{movie_id}", status_code=HTTP_202_ACCEPTED, response_model=schemas.Movie)
-async def update_movie(movie_id: int, movie: schemas.MovieBase, response: Response, request: Request, db: Session = Depends(get_db)):
-    logger.info(
-        f"{request.method} {request.url} {request.headers} {await request.json()}")
-    db_movie = db_queries.get_movie_by_id(db, movie_id)
+async def update_movie(movie_id: int, movie: schemas.MovieBase, response: Response, db: AsyncSession = Depends(get_async_db)):
+    db_movie = await async_db_queries.get_movie_by_id(db, movie_id)
     if not db_movie:
         raise HTTPException(
             status_code=404, detail=f"Missing movie with id {movie_id}")
     db_movie.title = movie.title
-    if movie.rating < 0 or movie.rating > 10:
+    if movie.rating is not None and (movie.rating < 0 or movie.rating > 10):
         raise HTTPException(
             status_code=400, detail="Rating must be between 0 and 10")
     db_movie.rating = movie.rating
     db_movie.year = movie.year
     db_movie.genre_id = movie.genre_id
     response.status_code = HTTP_200_OK
-    return db_queries.update_movie_complete(db=db, movie_id=movie_id, movie=db_movie)
+    try:
+        return await async_db_queries.update_movie_complete(db=db, movie_id=movie_id, movie=db_movie)
+    except db_queries.DuplicateMovieError:
+        raise HTTPException(status_code=409, detail="Movie already added")
 
 
 @app.patch("/api/v1/movies/{movie_id}", status_code=HTTP_202_ACCEPTED, response_model=schemas.Movie)
-async def partial_update_movie(movie_id: int, response: Response, request: Request, title: str | None = None, rating: float | None = None, year: int | None = None, genre_id: int | None = None, db: Session = Depends(get_db)):
-    logger.info(
-        f"{request.method} {request.url} {request.headers}")
-    db_movie = db_queries.get_movie_by_id(db, movie_id)
+async def partial_update_movie(movie_id: int, response: Response, title: str | None = None, rating: float | None = None, year: int | None = None, genre_id: int | None = None, db: AsyncSession = Depends(get_async_db)):
+    if rating and (rating < 0 or rating > 10):
+        raise HTTPException(
+            status_code=400, detail="Rating must be between 0 and 10")
+    if movie_writer is not None:
+        result = await movie_writer.submit(schemas.MovieBatchOperation(op="patch", id=movie_id, movie=schemas.MoviePatch(
+            title=title or None, rating=rating or None, year=year or None, genre_id=genre_id or None)))
+        if result.status != HTTP_200_OK:
+            raise HTTPException(status_code=result.status, detail=result.detail)
+        response.status_code = HTTP_200_OK
+        return result.movie
+    db_movie = await async_db_queries.get_movie_by_id(db, movie_id)
     if not db_movie:
         raise HTTPException(
             status_code=404, detail=f"Missing movie with id {movie_id}")
     if title:
         db_movie.title = title
     if rating:
-        if rating < 0 or rating > 10:
-            raise HTTPException(
-                status_code=400, detail="Rating must be between 0 and 10")
         db_movie.rating = rating
     if year:
         db_movie.year = year
     if genre_id:
         db_movie.genre_id = genre_id
     response.status_code = HTTP_200_OK
-    return db_queries.update_movie_partial(db=db, movie_id=movie_id, movie=db_movie)
+    try:
+        return await async_db_queries.update_movie_partial(db=db, movie_id=movie_id, movie=db_movie)
+    except db_queries.DuplicateMovieError:
+        raise HTTPException(status_code=409, detail="Movie already added")
 
 
-@app.get("/api/v1/movies/", status_code=HTTP_200_OK, response_model=list[schemas.Movie])
-def query_movies(response: Response, request: Request, q: str | None = None, limit: int | None = None, db: Session = Depends(get_db)):
-    logger.info(
-        f"{request.method} {request.url} {request.headers}")
-    if q:
-        db_movies = db_queries.get_movies_by_query(db=db, q=q, limit=limit)
-        if not db_movies:
-            raise HTTPException(status_code=404, detail="No movie was found")
-        response.status_code = HTTP_200_OK
-        return db_movies
-    db_movies = db_queries.get_movies(db=db, limit=limit)
-    response.status_code = HTTP_200_OK if len(
-        db_movies) > 0 else HTTP_204_NO_CONTENT
-    return db_movies
+@app.get("/api/v1/movies/", status_code=HTTP_200_OK, response_model=list[schemas.MovieWithGenre | schemas.Movie] | schemas.MovieSearchPage)
+def query_movies(request: Request, q: str | None = None, limit: int | None = None, sort: str | None = None, cursor: str | None = None, facets: str | None = None, fuzzy: bool = False, filters: schemas.MovieFilter = Depends(), expand: set[str] = Depends(parse_expand), db: Session = Depends(get_read_db)):
+    sort = sort or ("relevance" if q else "id")
+    facets = {facet.strip() for facet in facets.split(",") if facet.strip()} if facets else set()
+    if not facets <= set(db_queries.FACETS):
+        raise HTTPException(
+            status_code=400, detail=f"Facets must be among {', '.join(db_queries.FACETS)}")
+    if fuzzy and (not q or cursor or facets or sort != "relevance"):
+        raise HTTPException(
+            status_code=400, detail="Fuzzy search needs q and is ranked by similarity, without cursor or facets")
+    etag = f'"movies-{db_queries.get_table_version(db, "movies")}"'
+    if "genre" in expand:
+        etag = f'{etag[:-1]}-genres-{db_queries.get_genres_version(db=db)}"'
+    if not_modified(request, etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    try:
+        after = pagination.decode_cursor(cursor, sort) if cursor else None
+        if fuzzy:
+            db_movies = db_queries.get_movies_by_similarity(
+                db=db, q=q, limit=limit, filters=filters)
+        elif q:
+            db_movies = db_queries.get_movies_by_query(
+                db=db, q=q, limit=limit, sort=sort, after=after, filters=filters)
+        else:
+            db_movies = db_queries.get_movies(
+                db=db, limit=limit, sort=sort, after=after, filters=filters)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    if q and not db_movies and not cursor:
+        raise HTTPException(status_code=404, detail="No movie was found")
+    headers = {"ETag": etag}
+    if limit and len(db_movies) == limit and not fuzzy:
+        headers["X-Next-Cursor"] = pagination.encode_cursor(
+            sort, db_queries.get_sort_key(db, db_movies[-1], sort, q))
+    status_code = HTTP_200_OK if len(db_movies) > 0 else HTTP_204_NO_CONTENT
+    # the rows come straight from the database in the shape of schemas.Movie,
+    # so they skip response_model validation and are encoded by orjson
+    content = [row._asdict() for row in db_movies]
+    if "genre" in expand:
+        # genres come from the in-memory genre table, at most one query per page
+        genres = {genre.id: genre.dict() for genre in db_queries.get_genres_cached(db=db)}
+        for movie in content:
+            movie["genre"] = genres.get(movie["genre_id"])
+    if facets:
+        # facets count the whole result set, not only this page
+        content = {"movies": content, "facets": {
+            name: [count.dict() for count in counts]
+            for name, counts in db_queries.get_movie_facets(db=db, facets=facets, q=q, filters=filters).items()}}
+    return ORJSONResponse(content, status_code=status_code, headers=headers)
+
+
+@app.get("/api/v1/movies/suggest", status_code=HTTP_200_OK, response_model=list[schemas.MovieSuggestion])
+def suggest_movies(prefix: str, limit: int = 10, db: Session = Depends(get_read_db)):
+    if not 1 <= limit <= db_queries.title_suggestions.limit:
+        raise HTTPException(
+            status_code=400, detail=f"Limit must be between 1 and {db_queries.title_suggestions.limit}")
+    # an empty list rather than a 404, the search box asks on every keystroke
+    return ORJSONResponse([
+        {"id": movie_id, "title": title, "year": year, "rating": rating}
+        for movie_id, title, year, rating in db_queries.get_title_suggestions(db=db, prefix=prefix, limit=limit)])
 
 
-@app.get("/api/v1/movies/{movie_id}", status_code=HTTP_202_ACCEPTED, response_model=schemas.Movie)
-def get_movie_by_id(movie_id: int, response: Response, request: Request, db: Session = Depends(get_db)):
-    logger.info(
-        f"{request.method} {request.url} {request.headers}")
-    db_movie = db_queries.get_movie_by_id(db=db, movie_id=movie_id)
+@app.get("/api/v1/movies/export", status_code=HTTP_200_OK)
+def export_movies(request: Request, format: str = "ndjson", updated_since: datetime | None = None, db: Session = Depends(get_read_db)):
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(
+            status_code=400, detail="Format must be ndjson or csv")
+    if updated_since and updated_since.tzinfo:
+        updated_since = updated_since.astimezone(timezone.utc).replace(tzinfo=None)
+    rows = db_queries.export_movies(
+        db=db, updated_since=updated_since, batch_size=export.BATCH_SIZE)
+    chunks = export.encode_rows(rows, format)
+    headers = {"Vary": "Accept-Encoding"}
+    if export.accepts_gzip(request.headers.get("accept-encoding", "")):
+        chunks = export.gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, headers=headers, media_type="text/csv" if format == "csv" else "application/x-ndjson")
+
+
+@app.get("/api/v1/movies/{movie_id}", status_code=HTTP_202_ACCEPTED, response_model=schemas.MovieWithGenre | schemas.Movie)
+def get_movie_by_id(movie_id: int, response: Response, request: Request, expand: set[str] = Depends(parse_expand), db: Session = Depends(get_read_db)):
+    version = db_queries.get_movie_version(db=db, movie_id=movie_id)
+    if version is None:
+        raise HTTPException(
+            status_code=404, detail=f"Missing movie with id {movie_id}")
+    etag = f'"movie-{movie_id}-{version}"'
+    if "genre" in expand:
+        etag = f'{etag[:-1]}-genres-{db_queries.get_genres_version(db=db)}"'
+    if not_modified(request, etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    db_movie = db_queries.get_movie_by_id_cached(db=db, movie_id=movie_id)
     if not db_movie:
         raise HTTPException(
             status_code=404, detail=f"Missing movie with id {movie_id}")
+    response.headers["ETag"] = etag
     response.status_code = HTTP_200_OK
+    if "genre" in expand:
+        genres = {genre.id: genre for genre in db_queries.get_genres_cached(db=db)}
+        return schemas.MovieWithGenre(**db_movie.dict(), genre=genres.get(db_movie.genre_id))
     return db_movie
 
 
 @app.get("/api/v1/genres/", status_code=HTTP_202_ACCEPTED, response_model=list[schemas.Genre])
-def get_genres(response: Response, request: Request, db: Session = Depends(get_db)):
-    logger.info(
-        f"{request.method} {request.url} {request.headers}")
-    db_genres = db_queries.get_genres(db=db)
+def get_genres(response: Response, request: Request, db: Session = Depends(get_read_db)):
+    etag = f'"genres-{db_queries.get_genres_version(db=db)}"'
+    if not_modified(request, etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    db_genres = db_queries.get_genres_cached(db=db)
+    response.headers["ETag"] = etag
     response.status_code = HTTP_200_OK if len(
         db_genres) > 0 else HTTP_204_NO_CONTENT
     return db_genres
 
 
+@app.get("/api/v1/stats/{group}", status_code=HTTP_200_OK, response_model=list[schemas.MovieStats])
+def get_movie_stats(group: str, response: Response, request: Request, db: Session = Depends(get_read_db)):
+    if group not in db_queries.STATS_GROUPS:
+        raise HTTPException(
+            status_code=404, detail=f"Stats are grouped by {', '.join(db_queries.STATS_GROUPS)}")
+    etag = f'"stats-{group}-{db_queries.get_table_version(db, "movies")}"'
+    if not_modified(request, etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    stats = db_queries.get_movie_stats(db=db, group=group)
+    response.headers["ETag"] = etag
+    response.status_code = HTTP_200_OK if len(
+        stats) > 0 else HTTP_204_NO_CONTENT
+    return stats
+
+
+@app.get("/api/v1/db/pool", status_code=HTTP_200_OK)
+def get_pool_stats(current_user: schemas.User = Depends(get_current_active_user)):
+    return pool_stats()
+
+
+async def require_metrics_access(current_user: schemas.User | None = Depends(get_optional_active_user)):
+    if current_user is None and not metrics.METRICS_PUBLIC:
+        raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="Not authenticated",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_metrics_access)])
+def get_metrics():
+    return PlainTextResponse(metrics.render(pool_stats(), {
+        "movies": db_queries.movie_cache,
+        "genres": db_queries.genre_cache,
+        "tokens": token_cache,
+    }, {
+        "title_trigrams": db_queries.title_trigrams,
+        "title_suggestions": db_queries.title_suggestions,
+    }), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/api/v1/token", response_model=schemas.Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestFormStrict = Depends()):
-    user = authenticate_user(
+    user = await authenticate_user_async(
         fake_users_db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
@@ -163,12 +427,10 @@ async def read_users_me(current_user: schemas.User = Depends(get_current_active_
 
 
 @app.delete("/api/v1/movies/{movie_id}", status_code=HTTP_202_ACCEPTED, response_model=schemas.Movie)
-async def delete_movie(movie_id: int, response: Response, request: Request, db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_active_user)):
-    logger.info(
-        f"{request.method} {request.url} {request.headers}")
-    db_movie = db_queries.get_movie_by_id(db, movie_id)
+async def delete_movie(movie_id: int, response: Response, db: AsyncSession = Depends(get_async_db), current_user: schemas.User = Depends(get_current_active_user)):
+    db_movie = await async_db_queries.get_movie_by_id(db, movie_id)
     if not db_movie:
         raise HTTPException(
             status_code=404, detail=f"Missing movie with id {movie_id}")
     response.status_code = HTTP_200_OK
-    return db_queries.delete_movie(db=db, movie_id=movie_id)
+    return await async_db_queries.delete_movie(db=db, movie_id=movie_id)
@@ -0,0 +1,217 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+
+
+# /metrics asks for a bearer token unless the scraper is trusted to reach it
+METRICS_PUBLIC = os.environ.get("METRICS_PUBLIC", "false").lower() == "true"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+class Histogram:
+    """Fixed-bucket histogram. The buckets are allocated once, an observation
+    is a bisect and three additions."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Family:
+    """A metric with labels. Each label set gets its own child the first time
+    it is seen, later observations reuse it."""
+
+    def __init__(self, name: str, help: str, type: str, labels: tuple, factory):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.children = {}
+        self._factory = factory
+        self._lock = threading.Lock()
+
+    def child(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, self._factory())
+        return child
+
+
+def histogram_family(name: str, help: str, labels: tuple, buckets: tuple):
+    return Family(name, help, "histogram", labels, lambda: Histogram(buckets))
+
+
+def counter_family(name: str, help: str, labels: tuple):
+    return Family(name, help, "counter", labels, Counter)
+
+
+request_duration = histogram_family(
+    "http_request_duration_seconds", "Request latency by route", ("method", "route"), LATENCY_BUCKETS)
+responses = counter_family(
+    "http_responses_total", "Responses by route and status code", ("method", "route", "status"))
+query_duration = histogram_family(
+    "db_query_duration_seconds", "SQL statement latency by engine and db_queries function", ("engine", "query"), QUERY_BUCKETS)
+coalesced_requests = counter_family(
+    "http_coalesced_requests_total", "Requests that waited for an identical one in flight, by outcome", ("route", "outcome"))
+loop_lag = histogram_family(
+    "event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task", (), LATENCY_BUCKETS)
+
+FAMILIES = [request_duration, responses, coalesced_requests, query_duration, loop_lag]
+
+
+def _labels(names: tuple, values: tuple, extra: str = ""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _render_family(family: Family, lines: list):
+    lines.append(f"# HELP {family.name} {family.help}")
+    lines.append(f"# TYPE {family.name} {family.type}")
+    for values, child in sorted(family.children.items()):
+        if family.type == "counter":
+            lines.append(f"{family.name}{_labels(family.labels, values)} {child.value}")
+            continue
+        cumulative = 0
+        for bound, count in zip((*child.buckets, "+Inf"), child.counts):
+            cumulative += count
+            le = 'le="%s"' % bound
+            lines.append(
+                f"{family.name}_bucket{_labels(family.labels, values, le)} {cumulative}")
+        lines.append(f"{family.name}_sum{_labels(family.labels, values)} {child.sum}")
+        lines.append(f"{family.name}_count{_labels(family.labels, values)} {child.count}")
+
+
+def _render_gauges(name: str, help: str, type: str, label: str, values: dict, lines: list):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {type}")
+    for key, value in sorted(values.items()):
+        lines.append(f'{name}{{{label}="{key}"}} {value}')
+
+
+def render(pools: dict, caches: dict, indexes: dict):
+    """Prometheus text exposition of every metric, plus the pool statistics,
+    cache counters and index sizes that are kept elsewhere and only read here."""
+    lines = []
+    for family in FAMILIES:
+        _render_family(family, lines)
+    for stat, type, help in (
+            ("checked_out", "gauge", "Connections checked out"),
+            ("overflow", "gauge", "Connections opened above the pool size"),
+            ("checkouts", "counter", "Connection checkouts"),
+            ("wait_seconds", "counter", "Time spent waiting for a connection"),
+            ("max_wait_seconds", "gauge", "Longest wait for a connection")):
+        _render_gauges(f"db_pool_{stat}", help, type, "pool",
+                       {name: stats[stat] for name, stats in pools.items()}, lines)
+    for stat, type in (("size", "gauge"), ("hits", "counter"), ("misses", "counter"), ("evictions", "counter")):
+        _render_gauges(f"cache_{stat}", f"Cache {stat}", type, "cache",
+                       {name: cache.stats()[stat] for name, cache in caches.items()}, lines)
+    index_stats = {name: index.stats() for name, index in indexes.items()}
+    for stat, help in (
+            ("titles", "Titles indexed"),
+            ("trigrams", "Distinct trigrams"),
+            ("postings", "Entries in the posting lists"),
+            ("cached_prefixes", "Prefixes with cached results"),
+            ("bytes", "Memory held by the index")):
+        _render_gauges(f"index_{stat}", help, "gauge", "index",
+                       {name: stats[stat] for name, stats in index_stats.items() if stat in stats}, lines)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and counts its status code, labelled by the
+    route's path template so ids in the path do not create new series."""
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+        self._route_paths = None
+
+    def route_path(self, scope):
+        if self._route_paths is None:
+            self._route_paths = {route.endpoint: route.path for route in self.router.routes
+                                 if hasattr(route, "endpoint")}
+        return self._route_paths.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def capture_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capture_send)
+        finally:
+            route = self.route_path(scope)
+            request_duration.child(scope["method"], route).observe(
+                time.perf_counter() - start)
+            responses.child(scope["method"], route, str(status)).inc()
+
+
+QUERIES_MODULES = {f"{__package__}.db_queries", f"{__package__}.changes"}
+
+
+def _calling_query():
+    # the innermost db_queries (or change feed) function on the stack issued the statement
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_globals.get("__name__") in QUERIES_MODULES:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return "other"
+
+
+def instrument_engine(engine, name: str):
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        query_duration.child(name, _calling_query()).observe(
+            time.perf_counter() - context._metrics_started)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    lag = loop_lag.child()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, loop.time() - start - interval))
@@ -1,21 +1,96 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, Numeric, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import DDL, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, Numeric, String, event, func, literal_column
+from sqlalchemy.orm import relationship, validates
+from sqlalchemy.sql import column, table, text
 
 from .database import Base
 
 
+# current UTC time in the format SQLAlchemy stores DateTime columns in on
+# SQLite, strftime's %f only has milliseconds
+SQLITE_NOW = "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+def normalize_title(title: str | None):
+    return " ".join(title.casefold().split()) if title is not None else None
+
+
 class Movie(Base):
     __tablename__ = "movies"
 
-    id = Column(Integer, primary_key=True, index=True)
-    title = Column(String(20), index=True)
-    rating = Column(Numeric(1, 2), index=True)
-    year = Column(Integer, index=True)
-    is_active = Column(Boolean, index=True, default=True, nullable=False)
+    id = Column(Integer, primary_key=True)
+    title = Column(String(20))
+    normalized_title = Column(String(20))
+    rating = Column(Numeric(1, 2))
+    year = Column(Integer)
+    is_active = Column(Boolean, default=True, nullable=False)
+    version = Column(Integer, default=1, server_default="1", nullable=False)
+    updated_at = Column(DateTime, server_default=text(f"({SQLITE_NOW})"), nullable=False)
 
     genre_id = Column(Integer, ForeignKey("genres.id"))
     genre = relationship("Genre", back_populates="movies")
 
+    @validates("title")
+    def validate_title(self, key, title):
+        self.normalized_title = normalize_title(title)
+        return title
+
+
+# Listing indexes. Every list query filters on is_active, so each index is
+# partial and only holds active movies: soft deleted rows cost nothing to
+# scan or to keep indexed. The genre filter comes first where there is one,
+# then the sort key, with id as the keyset tie breaker. Unrated movies sort
+# as -1, below every valid rating, so the rating key is never NULL.
+movie_rating_key = func.ifnull(Movie.rating, literal_column("-1"))
+active_movies = Movie.is_active == True  # noqa: E712
+
+Index("ix_movies_active_id", Movie.id, sqlite_where=active_movies)
+Index("ix_movies_active_rating_id", movie_rating_key, Movie.id, sqlite_where=active_movies)
+Index("ix_movies_active_year_id", Movie.year, Movie.id, sqlite_where=active_movies)
+Index("ix_movies_active_title_id", Movie.title, Movie.id, sqlite_where=active_movies)
+Index("ix_movies_active_genre_id", Movie.genre_id, Movie.id, sqlite_where=active_movies)
+Index("ix_movies_active_genre_rating_id", Movie.genre_id, movie_rating_key, Movie.id,
+      sqlite_where=active_movies)
+Index("ix_movies_active_genre_year_id", Movie.genre_id, Movie.year, Movie.id,
+      sqlite_where=active_movies)
+# incremental exports read every change, soft deletes included
+Index("ix_movies_updated_at_id", Movie.updated_at, Movie.id)
+# soft deleted movies by age, for archiving (see db_queries.archive_deleted_movies)
+Index("ix_movies_deleted_updated_at", Movie.updated_at, sqlite_where=Movie.is_active == False)  # noqa: E712
+
+# an active movie is identified by its normalized title and year, soft
+# deleted movies do not block adding the same movie again
+movie_identity = (Movie.normalized_title, Movie.year)
+movie_identity_where = active_movies
+Index("uq_movies_active_normalized_title_year", *movie_identity,
+      unique=True, sqlite_where=movie_identity_where)
+
+# columns added to `movies` since its first release, with the type they are
+# added with to an older database (see db_queries.ensure_movie_columns).
+# ADD COLUMN only takes a constant default, rows get the real time afterwards.
+UPGRADED_UPDATED_AT = "1970-01-01 00:00:00.000000"
+MOVIE_ADDED_COLUMNS = {
+    "normalized_title": "VARCHAR(20)",
+    "version": "INTEGER NOT NULL DEFAULT 1",
+    "updated_at": f"DATETIME NOT NULL DEFAULT '{UPGRADED_UPDATED_AT}'",
+}
+# single column indexes of the first release, replaced by the listing indexes above
+MOVIE_DROPPED_INDEXES = ["ix_movies_id", "ix_movies_title", "ix_movies_rating", "ix_movies_year", "ix_movies_is_active"]
+
+
+class ArchivedMovie(Base):
+    __tablename__ = "movies_archive"
+
+    # soft deleted movies moved out of `movies` once past the retention window
+    id = Column(Integer, primary_key=True)
+    title = Column(String(20))
+    normalized_title = Column(String(20))
+    rating = Column(Numeric(1, 2))
+    year = Column(Integer)
+    genre_id = Column(Integer)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    archived_at = Column(DateTime, server_default=text(f"({SQLITE_NOW})"), nullable=False)
+
 
 class Genre(Base):
     __tablename__ = "genres"
@@ -25,3 +100,165 @@ class Genre(Base):
     is_active = Column(Boolean, index=True, default=True, nullable=False)
 
     movies = relationship("Movie", back_populates="genre")
+
+
+class MovieStat(Base):
+    __tablename__ = "movie_stats"
+
+    # 0 stands for a missing genre or year, bucket -1 for unrated movies
+    genre_id = Column(Integer, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+    rating_sum = Column(Float, default=0, nullable=False)
+
+
+class TableVersion(Base):
+    __tablename__ = "table_versions"
+
+    name = Column(String(20), primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+
+
+# FTS5 index over the titles of active movies. It is maintained by triggers,
+# so every write to `movies` (create, update, soft delete) keeps it in sync.
+movies_fts = table("movies_fts", column("rowid", Integer), column("title", String))
+
+MOVIES_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5(title)",
+    """CREATE TRIGGER IF NOT EXISTS movies_fts_ai AFTER INSERT ON movies WHEN new.is_active
+    BEGIN
+        INSERT INTO movies_fts(rowid, title) VALUES (new.id, new.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movies_fts_au AFTER UPDATE OF title, is_active ON movies
+    BEGIN
+        DELETE FROM movies_fts WHERE rowid = old.id;
+        INSERT INTO movies_fts(rowid, title) SELECT new.id, new.title WHERE new.is_active;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movies_fts_ad AFTER DELETE ON movies
+    BEGIN
+        DELETE FROM movies_fts WHERE rowid = old.id;
+    END""",
+]
+
+for statement in MOVIES_FTS_DDL:
+    event.listen(Movie.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Movie.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS movies_fts").execute_if(dialect="sqlite"))
+
+
+# Every write to a tracked table bumps its row in `table_versions`, and every
+# update of a movie bumps its `version` and `updated_at`. ETags are built from these counters.
+TABLE_VERSION_TRIGGER = """CREATE TRIGGER IF NOT EXISTS {table}_table_version_{suffix} AFTER {event} ON {table}
+    BEGIN
+        INSERT INTO table_versions(name, version) VALUES ('{table}', 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1;
+    END"""
+MOVIE_VERSIONED_COLUMNS = "title, rating, year, genre_id, is_active"
+
+VERSION_DDL = {
+    "movies": [
+        TABLE_VERSION_TRIGGER.format(table="movies", suffix="ai", event="INSERT"),
+        TABLE_VERSION_TRIGGER.format(
+            table="movies", suffix="au", event=f"UPDATE OF {MOVIE_VERSIONED_COLUMNS}"),
+        TABLE_VERSION_TRIGGER.format(table="movies", suffix="ad", event="DELETE"),
+        f"""CREATE TRIGGER IF NOT EXISTS movies_version_au AFTER UPDATE OF {MOVIE_VERSIONED_COLUMNS} ON movies
+    BEGIN
+        UPDATE movies SET version = old.version + 1, updated_at = {SQLITE_NOW} WHERE id = new.id;
+    END""",
+        # on an upgraded database the column default is a constant
+        f"""CREATE TRIGGER IF NOT EXISTS movies_updated_at_ai AFTER INSERT ON movies
+    WHEN new.updated_at = '{UPGRADED_UPDATED_AT}'
+    BEGIN
+        UPDATE movies SET updated_at = {SQLITE_NOW} WHERE id = new.id;
+    END""",
+    ],
+    "genres": [
+        TABLE_VERSION_TRIGGER.format(table="genres", suffix="ai", event="INSERT"),
+        TABLE_VERSION_TRIGGER.format(table="genres", suffix="au", event="UPDATE"),
+        TABLE_VERSION_TRIGGER.format(table="genres", suffix="ad", event="DELETE"),
+    ],
+}
+
+for model in (Movie, Genre):
+    for statement in VERSION_DDL[model.__tablename__]:
+        # DDL() formats the statement with %, strftime's % signs are escaped
+        event.listen(model.__table__, "after_create",
+                     DDL(statement.replace("%", "%%")).execute_if(dialect="sqlite"))
+
+
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+    # AUTOINCREMENT never reuses an id, so readers can resume after the last one they saw
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(20), nullable=False)
+    row_id = Column(Integer, nullable=False)
+
+
+# Every change that can make a cached movie or genre list stale is appended
+# to `change_log`, whichever process or code path wrote it, so each worker
+# can drop what it cached (see changes.ChangeFeed). New movies are not
+# logged: a movie is only cached once it exists.
+CHANGE_LOG_TRIGGER = """CREATE TRIGGER IF NOT EXISTS {table}_change_log_{suffix} AFTER {event} ON {table}
+    BEGIN
+        INSERT INTO change_log(table_name, row_id) VALUES ('{table}', {row}.id);
+    END"""
+
+CHANGE_LOG_DDL = {
+    "movies": [
+        CHANGE_LOG_TRIGGER.format(
+            table="movies", suffix="au", event=f"UPDATE OF {MOVIE_VERSIONED_COLUMNS}", row="new"),
+        CHANGE_LOG_TRIGGER.format(table="movies", suffix="ad", event="DELETE", row="old"),
+    ],
+    "genres": [
+        CHANGE_LOG_TRIGGER.format(table="genres", suffix="ai", event="INSERT", row="new"),
+        CHANGE_LOG_TRIGGER.format(table="genres", suffix="au", event="UPDATE", row="new"),
+        CHANGE_LOG_TRIGGER.format(table="genres", suffix="ad", event="DELETE", row="old"),
+    ],
+}
+
+for model in (Movie, Genre):
+    for statement in CHANGE_LOG_DDL[model.__tablename__]:
+        event.listen(model.__table__, "after_create",
+                     DDL(statement).execute_if(dialect="sqlite"))
+
+
+# Active movies counted per (genre, year, rating bucket) in `movie_stats`.
+# Like the version counters it is maintained by triggers, so creates, updates,
+# soft deletes, batches and bulk imports all keep it current.
+MOVIE_STATS_KEY = "ifnull({row}.genre_id, 0), ifnull({row}.year, 0), ifnull(CAST({row}.rating AS INTEGER), -1)"
+MOVIE_STATS_ADD = """INSERT INTO movie_stats(genre_id, year, bucket, count, rating_sum)
+        SELECT {key}, 1, ifnull(new.rating, 0) WHERE new.is_active
+        ON CONFLICT(genre_id, year, bucket) DO UPDATE
+        SET count = count + 1, rating_sum = rating_sum + excluded.rating_sum;""".format(
+    key=MOVIE_STATS_KEY.format(row="new"))
+MOVIE_STATS_REMOVE = """UPDATE movie_stats SET count = count - 1, rating_sum = rating_sum - ifnull(old.rating, 0)
+        WHERE old.is_active AND (genre_id, year, bucket) = ({key});
+        DELETE FROM movie_stats WHERE count = 0 AND (genre_id, year, bucket) = ({key});""".format(
+    key=MOVIE_STATS_KEY.format(row="old"))
+
+MOVIE_STATS_DDL = [
+    f"""CREATE TRIGGER IF NOT EXISTS movie_stats_ai AFTER INSERT ON movies
+    BEGIN
+        {MOVIE_STATS_ADD}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS movie_stats_au AFTER UPDATE OF rating, year, genre_id, is_active ON movies
+    BEGIN
+        {MOVIE_STATS_REMOVE}
+        {MOVIE_STATS_ADD}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS movie_stats_ad AFTER DELETE ON movies
+    BEGIN
+        {MOVIE_STATS_REMOVE}
+    END""",
+]
+# the same aggregate computed from scratch, for rebuilds and consistency checks
+MOVIE_STATS_SELECT = f"""SELECT {MOVIE_STATS_KEY.format(row="movies")}, count(*), sum(ifnull(rating, 0))
+    FROM movies WHERE is_active GROUP BY 1, 2, 3"""
+
+for statement in MOVIE_STATS_DDL:
+    event.listen(Movie.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
@@ -0,0 +1,37 @@
+import base64
+import binascii
+import json
+
+
+# types a cursor's sort value can have, see db_queries.get_sort_key
+CURSOR_VALUE_TYPES = {
+    "id": (int,),
+    "year": (int,),
+    "title": (str,),
+    "rating": (int, float),
+    "relevance": (int, float),
+}
+
+
+def _is_a(value, types: tuple):
+    # bool is an int to isinstance, but never a sort value
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def encode_cursor(sort: str, key: tuple):
+    payload = json.dumps([sort, list(key)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, key = json.loads(payload)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort or not isinstance(key, list) or len(key) != 2:
+        raise ValueError("Cursor does not belong to this sort order")
+    value, movie_id = key
+    if not _is_a(value, CURSOR_VALUE_TYPES.get(sort.removeprefix("-"), ())) or not _is_a(movie_id, (int,)):
+        raise ValueError("Invalid cursor")
+    return tuple(key)
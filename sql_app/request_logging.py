@@ -0,0 +1,131 @@
+import atexit
+import json
+import logging
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from urllib.parse import parse_qsl, urlencode
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON lines. Runs on the listener thread, so the
+    request data is decoded and redacted there instead of on the request path."""
+
+    def __init__(self, redact_headers=(), redact_body_fields=(), datefmt=None):
+        super().__init__(datefmt=datefmt)
+        self.redact_headers = {name.lower() for name in redact_headers}
+        self.redact_fields = {name.lower() for name in redact_body_fields}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request = getattr(record, "request", None)
+        if request:
+            entry.update(request)
+            entry["headers"] = {
+                name.decode("latin-1"): "***" if name.decode("latin-1") in self.redact_headers else value.decode("latin-1")
+                for name, value in request["headers"]
+            }
+            entry["query"] = self.redact_form(request["query"])
+            body = request["body"].decode("utf-8", errors="replace")
+            content_type = entry["headers"].get("content-type", "")
+            if self.redact_fields and body and content_type.startswith("application/json"):
+                try:
+                    body = json.dumps(self.redact_json(json.loads(body)))
+                except ValueError:
+                    # cut at max_body_bytes, the fields can not be told apart
+                    body = "***"
+            elif content_type.startswith("application/x-www-form-urlencoded"):
+                body = self.redact_form(body)
+            entry["body"] = body
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+    def redact_json(self, value):
+        if isinstance(value, dict):
+            return {key: "***" if key.lower() in self.redact_fields else self.redact_json(item)
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.redact_json(item) for item in value]
+        return value
+
+    def redact_form(self, data: str):
+        if not self.redact_fields or not data:
+            return data
+        return urlencode([(key, "***" if key.lower() in self.redact_fields else value)
+                          for key, value in parse_qsl(data, keep_blank_values=True)], safe="*")
+
+
+class _EnqueueHandler(QueueHandler):
+    # the default prepare() formats the message on the caller's thread, the
+    # listener's handlers format it anyway
+    def prepare(self, record):
+        return record
+
+
+def move_handlers_to_queue(logger: logging.Logger):
+    """Replace the handlers of `logger` with a queue drained by a background
+    listener thread, so logging calls only enqueue the record."""
+    queue = SimpleQueue()
+    listener = QueueListener(queue, *logger.handlers,
+                             respect_handler_level=True)
+    logger.handlers = [_EnqueueHandler(queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class RequestLoggingMiddleware:
+    """ASGI middleware that logs one structured record per request.
+
+    The request body is captured from the raw `http.request` messages as they
+    are received, up to `max_body_bytes`. Requests are sampled with
+    `sample_rate`, server errors are always logged.
+    """
+
+    def __init__(self, app, logger: logging.Logger, sample_rate: float = 1.0, max_body_bytes: int = 4096):
+        self.app = app
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        body = bytearray()
+        status = 500
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request" and len(body) < self.max_body_bytes:
+                body.extend(message.get("body", b"")[
+                            :self.max_body_bytes - len(body)])
+            return message
+
+        async def capture_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            if status >= 500 or self.sample_rate >= 1 or random.random() < self.sample_rate:
+                self.logger.info("request", extra={"request": {
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "query": scope["query_string"].decode("latin-1"),
+                    "status": status,
+                    "duration_ms": (time.perf_counter() - start) * 1000,
+                    "client": scope["client"][0] if scope.get("client") else None,
+                    "headers": scope["headers"],
+                    "body": bytes(body),
+                }})
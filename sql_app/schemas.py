@@ -1,5 +1,6 @@
 from tkinter.messagebox import NO
-from pydantic import BaseModel
+from typing import Literal
+from pydantic import BaseModel, Field
 
 
 class MovieBase(BaseModel):
@@ -16,6 +17,74 @@ class Movie(MovieBase):
         orm_mode = True
 
 
+class MoviePatch(BaseModel):
+    title: str | None = None
+    rating: float | None = None
+    year: int | None = None
+    genre_id: int | None = None
+
+
+class MovieSuggestion(BaseModel):
+    id: int
+    title: str
+    year: int
+    rating: float | None = None
+
+
+class MovieFilter(BaseModel):
+    genre_id: int | None = None
+    year_min: int | None = None
+    year_max: int | None = None
+    rating_min: float | None = None
+    rating_max: float | None = None
+
+
+class FacetCount(BaseModel):
+    value: int
+    name: str | None = None
+    count: int
+
+
+class MovieSearchPage(BaseModel):
+    movies: list[Movie]
+    facets: dict[str, list[FacetCount]]
+
+
+class MovieBatchOperation(BaseModel):
+    op: Literal["create", "update", "patch", "delete"]
+    id: int | None = None
+    movie: MoviePatch | None = None
+
+
+class MovieBatchResult(BaseModel):
+    status: int
+    detail: str | None = None
+    movie: Movie | None = None
+
+
+class ImportRejection(BaseModel):
+    line: int
+    reason: str
+
+
+class ImportReport(BaseModel):
+    inserted: int = 0
+    rejected: int = 0
+    seconds: float = 0
+    rows_per_second: float = 0
+    rejections: list[ImportRejection] = []
+
+
+class MovieStats(BaseModel):
+    # `key` is the genre id or the year, 0 when the movie has none
+    key: int
+    count: int
+    rated: int
+    average_rating: float | None = None
+    # histogram[n] counts ratings in [n, n + 1), the last bucket is exactly 10
+    histogram: list[int]
+
+
 class GenreBase(BaseModel):
     name: str
 
@@ -27,6 +96,11 @@ class Genre(GenreBase):
         orm_mode = True
 
 
+class MovieWithGenre(Movie):
+    # required, so a plain Movie never validates as a MovieWithGenre
+    genre: Genre | None = Field(...)
+
+
 class User(BaseModel):
     username: str
     email: str | None = None
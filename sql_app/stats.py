@@ -0,0 +1,43 @@
+"""Maintenance of the movie_stats summary table.
+
+    python -m sql_app.stats check
+    python -m sql_app.stats rebuild
+
+The table is kept current by triggers on `movies`. `check` compares it with
+an aggregate computed from scratch and exits with 1 when they differ,
+`rebuild` recomputes it.
+"""
+import argparse
+import sys
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from . import db_queries, models
+from .database import SQLALCHEMY_DATABASE_URL
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check or rebuild the movie statistics")
+    parser.add_argument("command", choices=["check", "rebuild"])
+    parser.add_argument("--database-url", default=SQLALCHEMY_DATABASE_URL)
+    args = parser.parse_args(argv)
+
+    engine = sa.create_engine(args.database_url)
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    try:
+        if args.command == "rebuild":
+            db_queries.ensure_movie_stats(db)
+            db_queries.rebuild_movie_stats(db)
+        mismatches = db_queries.check_movie_stats(db)
+    finally:
+        db.close()
+    for genre_id, year, bucket in mismatches:
+        print(f"genre_id {genre_id} year {year} bucket {bucket} is out of date")
+    print(f"{len(mismatches)} inconsistent rows")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
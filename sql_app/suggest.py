@@ -0,0 +1,185 @@
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from heapq import nlargest
+
+from .models import normalize_title
+
+
+# prefixes matching more titles than this keep their top results cached
+CACHED_RANGE = 512
+
+
+class SuggestIndex:
+    """Sorted in-memory index of normalized titles for prefix autocomplete.
+
+    The titles of a prefix are a contiguous range of the sorted keys, found
+    with two binary searches. Ids and weights (the rating, -1 when unrated)
+    sit in arrays parallel to the keys. Prefixes with a range larger than
+    CACHED_RANGE keep their best results, computed at build time and
+    patched on writes, so a lookup rarely scans more than CACHED_RANGE
+    entries. Each cached prefix keeps twice `limit` results so removals
+    seldom force it to be computed again.
+    """
+
+    def __init__(self, limit: int = 10):
+        self.limit = limit
+        self._keys = []
+        self._ids = array("I")
+        self._weights = array("d")
+        # movie id -> (key, title, year, weight)
+        self._movies = {}
+        # prefix -> [(weight, key, movie id)] best first
+        self._top = {}
+        self._lock = threading.Lock()
+        # held while catching up with the database, by one thread at a time
+        self.sync_lock = threading.Lock()
+        # newest updated_at applied, see db_queries.sync_title_suggestions
+        self.synced_at = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def build(self, rows):
+        """Replace the index with (movie_id, title, year, rating) rows."""
+        movies = {}
+        for movie_id, title, year, rating in rows:
+            key = normalize_title(title)
+            if key:
+                movies[movie_id] = (key, title, year, -1.0 if rating is None else rating)
+        order = sorted(movies, key=lambda movie_id: (movies[movie_id][0], movie_id))
+        with self._lock:
+            self._movies = movies
+            self._keys = [movies[movie_id][0] for movie_id in order]
+            self._ids = array("I", order)
+            self._weights = array("d", (movies[movie_id][3] for movie_id in order))
+            self._top = {}
+            self._cache_ranges(0, len(self._keys), 0)
+
+    def add(self, movie_id: int, title: str, year: int, rating: float | None):
+        key = normalize_title(title)
+        weight = -1.0 if rating is None else rating
+        with self._lock:
+            if self._movies.get(movie_id) == (key, title, year, weight):
+                return
+            self._remove(movie_id)
+            if not key:
+                return
+            self._movies[movie_id] = (key, title, year, weight)
+            position = self._position(key, movie_id)
+            self._keys.insert(position, key)
+            self._ids.insert(position, movie_id)
+            self._weights.insert(position, weight)
+            item = (weight, key, movie_id)
+            for prefix, top in self._cached_prefixes(key):
+                if _rank(item) < _rank(top[-1]):
+                    top.append(item)
+                    top.sort(key=_rank)
+                    del top[self.limit * 2:]
+                elif len(top) < self.limit * 2:
+                    # shrunk by removals, the titles ranked between its last
+                    # entry and this one are not known any more
+                    del self._top[prefix]
+
+    def remove(self, movie_id: int):
+        with self._lock:
+            self._remove(movie_id)
+
+    def _remove(self, movie_id: int):
+        current = self._movies.pop(movie_id, None)
+        if current is None:
+            return
+        key = current[0]
+        position = self._position(key, movie_id)
+        del self._keys[position]
+        del self._ids[position]
+        del self._weights[position]
+        for prefix, top in self._cached_prefixes(key):
+            top[:] = [item for item in top if item[2] != movie_id]
+            if len(top) < self.limit:
+                del self._top[prefix]
+
+    def _cached_prefixes(self, key: str):
+        return [(key[:end], self._top[key[:end]]) for end in range(1, len(key) + 1)
+                if key[:end] in self._top]
+
+    def _scan(self, start: int, end: int):
+        return nlargest(self.limit * 2, (
+            (self._weights[i], self._keys[i], self._ids[i]) for i in range(start, end)),
+            key=lambda item: item[0])
+
+    def _cache_ranges(self, start: int, end: int, depth: int):
+        # best results of keys[start:end], which share their first `depth`
+        # characters, from the results of each next character's range
+        if end - start <= CACHED_RANGE:
+            return self._scan(start, end)
+        prefix = self._keys[start][:depth]
+        position = start
+        while position < end and len(self._keys[position]) == depth:
+            position += 1
+        top = self._scan(start, position)
+        while position < end:
+            child = self._keys[position][:depth + 1]
+            child_end = bisect_left(self._keys, child + "\U0010ffff", position, end)
+            top.extend(self._cache_ranges(position, child_end, depth + 1))
+            position = child_end
+        top.sort(key=_rank)
+        del top[self.limit * 2:]
+        if depth:
+            self._top[prefix] = top
+        return top
+
+    def _position(self, key: str, movie_id: int):
+        position = bisect_left(self._keys, key)
+        while position < len(self._keys) and self._keys[position] == key \
+                and self._ids[position] < movie_id:
+            position += 1
+        return position
+
+    def clear(self):
+        with self._lock:
+            self._keys = []
+            self._ids = array("I")
+            self._weights = array("d")
+            self._movies = {}
+            self._top = {}
+            self.synced_at = None
+
+    def suggest(self, prefix: str, limit: int | None = None):
+        """Best rated titles starting with `prefix`, alphabetical among equal
+        ratings, as (movie_id, title, year, rating)."""
+        limit = min(limit or self.limit, self.limit)
+        prefix = normalize_title(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            top = self._top.get(prefix)
+            if top is None:
+                start = bisect_left(self._keys, prefix)
+                end = bisect_left(self._keys, prefix + "\U0010ffff", start)
+                top = self._scan(start, end)
+                if end - start > CACHED_RANGE:
+                    self._top[prefix] = top
+            results = []
+            for weight, _, movie_id in top[:limit]:
+                _, title, year, _ = self._movies[movie_id]
+                results.append((movie_id, title, year, None if weight < 0 else weight))
+        return results
+
+    def stats(self):
+        with self._lock:
+            arrays = sum(values.buffer_info()[1] * values.itemsize
+                         for values in (self._ids, self._weights))
+            strings = sum(sys.getsizeof(key) + sys.getsizeof(title)
+                          for key, title, _, _ in self._movies.values())
+            return {
+                "titles": len(self._keys),
+                "cached_prefixes": len(self._top),
+                "bytes": arrays + strings + sys.getsizeof(self._keys) + sys.getsizeof(self._movies),
+            }
+
+
+def _rank(item):
+    weight, key, movie_id = item
+    return -weight, key, movie_id
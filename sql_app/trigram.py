@@ -0,0 +1,195 @@
+import math
+import re
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from heapq import nsmallest
+from itertools import chain
+
+from .models import normalize_title
+
+
+_EMPTY = array("I")
+# Bounds on the work of one search. Candidates are read from the shortest
+# posting lists of the query up to MAX_COUNTED_POSTINGS postings, and the
+# MAX_CANDIDATES sharing the most of them are scored. Common trigrams
+# (" th", "the", ...) are then never read, so titles matching through them
+# alone can be missed; the scores of the titles found are exact.
+MAX_COUNTED_POSTINGS = 10000
+MAX_CANDIDATES = 300
+
+
+def _words(title: str):
+    return re.findall(r"\w+", normalize_title(title) or "")
+
+
+def trigrams(title: str):
+    """Trigrams of every word, padded like pg_trgm: two spaces in front and
+    one behind, so short words and word starts weigh more."""
+    grams = set()
+    for word in _words(title):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _shared(grams: set, title: str):
+    # Every window of 3 across two words holds two spaces behind a letter or
+    # three spaces, which no trigram has, so the trigrams of `grams` found
+    # in the padded words are exactly those the title has.
+    words = title.casefold().split()
+    if not "".join(words).isalnum():
+        words = _words(title)
+    padded = "  " + "   ".join(words) + " "
+    return len([gram for gram in grams if gram in padded])
+
+
+class TrigramIndex:
+    """In-memory trigram index of movie titles for typo tolerant search.
+
+    Each trigram maps to a sorted array of unsigned 32 bit movie ids, so a
+    posting costs 4 bytes instead of a set entry. Titles are kept to check
+    search candidates and to remove their postings when a movie changes,
+    and the trigram count of every title, needed for the similarity, in an
+    array indexed by movie id.
+    """
+
+    def __init__(self, max_counted_postings: int | None = MAX_COUNTED_POSTINGS,
+                 max_candidates: int | None = MAX_CANDIDATES):
+        # None lifts a bound, the search is then exhaustive
+        self.max_counted_postings = max_counted_postings
+        self.max_candidates = max_candidates
+        self._postings = {}
+        self._titles = {}
+        self._sizes = array("H")
+        self._lock = threading.Lock()
+        # held while catching up with the database, by one thread at a time
+        self.sync_lock = threading.Lock()
+        # newest updated_at applied, see db_queries.sync_title_trigrams
+        self.synced_at = None
+
+    def __len__(self):
+        return len(self._titles)
+
+    def add(self, movie_id: int, title: str):
+        with self._lock:
+            if self._titles.get(movie_id) == title:
+                return
+            self._remove(movie_id)
+            grams = trigrams(title)
+            if not grams:
+                return
+            self._titles[movie_id] = title
+            if movie_id >= len(self._sizes):
+                grow = max(movie_id + 1 - len(self._sizes), len(self._sizes))
+                self._sizes.frombytes(bytes(grow * self._sizes.itemsize))
+            self._sizes[movie_id] = min(len(grams), 65535)
+            for gram in grams:
+                postings = self._postings.get(gram)
+                if postings is None:
+                    postings = self._postings[gram] = array("I")
+                if not postings or postings[-1] < movie_id:
+                    postings.append(movie_id)
+                else:
+                    postings.insert(bisect_left(postings, movie_id), movie_id)
+
+    def build(self, rows):
+        """Replace the index with (movie_id, title) rows sorted by id, appending
+        straight to the posting arrays."""
+        postings, titles, sizes = {}, {}, array("H")
+        for movie_id, title in rows:
+            grams = trigrams(title)
+            if not grams:
+                continue
+            titles[movie_id] = title
+            if movie_id >= len(sizes):
+                grow = max(movie_id + 1 - len(sizes), len(sizes))
+                sizes.frombytes(bytes(grow * sizes.itemsize))
+            sizes[movie_id] = min(len(grams), 65535)
+            for gram in grams:
+                gram_postings = postings.get(gram)
+                if gram_postings is None:
+                    gram_postings = postings[gram] = array("I")
+                gram_postings.append(movie_id)
+        with self._lock:
+            self._postings, self._titles, self._sizes = postings, titles, sizes
+
+    def remove(self, movie_id: int):
+        with self._lock:
+            self._remove(movie_id)
+
+    def _remove(self, movie_id: int):
+        title = self._titles.pop(movie_id, None)
+        if title is None:
+            return
+        for gram in trigrams(title):
+            postings = self._postings[gram]
+            i = bisect_left(postings, movie_id)
+            if i < len(postings) and postings[i] == movie_id:
+                del postings[i]
+            if not postings:
+                del self._postings[gram]
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._titles.clear()
+            self._sizes = array("H")
+            self.synced_at = None
+
+    def search(self, q: str, limit: int | None = 100, threshold: float = 0.3):
+        """Movie ids whose title has a trigram similarity (Jaccard) of at
+        least `threshold` with `q`, best first, as (movie_id, similarity)."""
+        grams = trigrams(q)
+        if not grams:
+            return []
+        with self._lock:
+            # similarity >= threshold needs `needed` shared trigrams, so every
+            # match is in one of the len(grams) - needed + 1 shortest lists.
+            # Those are counted, then each candidate is checked against its
+            # title instead of being looked up in the longer lists.
+            needed = max(1, math.ceil(threshold * len(grams)))
+            lists = sorted((self._postings.get(gram, _EMPTY) for gram in grams), key=len)
+            counted = [postings for postings in lists[:len(grams) - needed + 1] if postings]
+            if counted and self.max_counted_postings is not None:
+                # the shortest lists fitting in the budget, or the start of
+                # the shortest one
+                short, total = 0, 0
+                for postings in counted:
+                    total += len(postings)
+                    if total > self.max_counted_postings:
+                        break
+                    short += 1
+                counted = counted[:short] or [counted[0][:self.max_counted_postings]]
+            counts = Counter(chain.from_iterable(counted))
+            if self.max_candidates is not None and len(counts) > self.max_candidates:
+                candidates = [movie_id for movie_id, _ in counts.most_common(self.max_candidates)]
+            else:
+                candidates = counts
+            scored = []
+            for movie_id in candidates:
+                shared = _shared(grams, self._titles[movie_id])
+                if shared < needed:
+                    continue
+                similarity = shared / (len(grams) + self._sizes[movie_id] - shared)
+                if similarity >= threshold:
+                    scored.append((movie_id, similarity))
+        key = lambda item: (-item[1], item[0])
+        return sorted(scored, key=key) if limit is None else nsmallest(limit, scored, key=key)
+
+    def stats(self):
+        with self._lock:
+            postings = sum(len(postings) for postings in self._postings.values())
+            posting_bytes = sum(postings.buffer_info()[1] * postings.itemsize
+                                for postings in self._postings.values())
+            title_bytes = sum(sys.getsizeof(title) for title in self._titles.values()) + \
+                self._sizes.buffer_info()[1] * self._sizes.itemsize
+            return {
+                "titles": len(self._titles),
+                "trigrams": len(self._postings),
+                "postings": postings,
+                "bytes": posting_bytes + title_bytes
+                + sys.getsizeof(self._postings) + sys.getsizeof(self._titles),
+            }
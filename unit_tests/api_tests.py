@@ -1,62 +1,90 @@
-from sql_app.main import app, get_db
-from sql_app import models
-from sql_app.database import Base
+import os
+import tempfile
+
+# requests made by the tests are not logged to sql_app/logs
+os.environ["LOG_FILE"] = os.path.join(tempfile.mkdtemp(), "request_logs.log")
+
+from sql_app.main import COALESCED_PATHS, app, get_async_db, get_db, get_read_db
+from sql_app import auth, bulk_import, changes, coalesce, compact, db_queries, export, group_commit, metrics, models, pagination, schemas, stats, suggest, trigram
+from sql_app.cache import LRUCache
+from sql_app.database import Base, ReadSessionLocal
+from sql_app.request_logging import JsonFormatter
+import asyncio
+import csv
+import gzip
+import itertools
+import json
+import logging
 import pytest
+import re
 import sqlalchemy as sa
+import threading
+import time
+from datetime import datetime
 from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 
 engine = sa.create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(
     autocommit=False, autoflush=False, bind=engine)
+# every request runs on its own event loop in TestClient, so async connections are not pooled
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=NullPool)
+TestingAsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession)
 
 Base.metadata.drop_all(bind=engine)
 Base.metadata.create_all(bind=engine)
-
-
-@sa.event.listens_for(engine, "connect")
-def do_connect(dbapi_connection, connection_record):
-    dbapi_connection.isolation_level = None
-
-
-@sa.event.listens_for(engine, "begin")
-def do_begin(conn):
-    conn.exec_driver_sql("BEGIN")
+metrics.instrument_engine(engine, "test")
 
 
 @pytest.fixture()
 def session():
-    connection = engine.connect()
-    transaction = connection.begin()
-    session = TestingSessionLocal(bind=connection)
-    nested = connection.begin_nested()
-
-    @sa.event.listens_for(session, "after_transaction_end")
-    def end_savepoint(session, transaction):
-        nonlocal nested
-        if not nested.is_active:
-            nested = connection.begin_nested()
+    # the sync and async layers use different connections, so test data is
+    # really committed and every table is emptied afterwards
+    session = TestingSessionLocal()
 
     yield session
 
     session.close()
-    transaction.rollback()
-    connection.close()
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    db_queries.movie_cache.clear()
+    db_queries.genre_cache.clear()
+    db_queries.title_trigrams.clear()
+    db_queries.title_suggestions.clear()
+    db_queries.change_feed.reset()
 
 
 @pytest.fixture()
 def client(session):
     def override_get_db():
-        yield session
+        db = TestingSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        async with TestingAsyncSessionLocal() as db:
+            yield db
 
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
     yield TestClient(app)
     del app.dependency_overrides[get_db]
+    del app.dependency_overrides[get_read_db]
+    del app.dependency_overrides[get_async_db]
 
 
 def test_get_no_movies(client):
@@ -108,6 +136,17 @@ def test_should_update_movie_complete(client, session):
                                "year": 2001, "rating": 9, "genre_id": 1}
 
 
+def test_should_update_movie_complete_without_rating(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    response = client.put(
+        "/api/v1/movies/1", json={"title": "Movie 2", "year": 2001, "rating": None, "genre_id": 1})
+    assert response.status_code == 200
+    assert response.json() == {"id": 1, "title": "Movie 2",
+                               "year": 2001, "rating": None, "genre_id": 1}
+
+
 def test_should_update_movie_partial(client, session):
     session.add(models.Genre(name="Action"))
     session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
@@ -206,4 +245,1109 @@ def test_should_get_all_genres(client, session):
     ]
 
 
+def test_should_rank_query_results_by_relevance(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Star Trek", year=1979, rating=6, genre_id=1))
+    session.add(models.Movie(title="Star Wars", year=1977, rating=9, genre_id=1))
+    session.add(models.Movie(title="Wars of Star Wars", year=2001, rating=2, genre_id=1))
+    session.commit()
+    response = client.get("/api/v1/movies/?q=star%20war")
+    assert response.status_code == 200
+    assert [movie["id"] for movie in response.json()] == [2, 3]
+
+
+def test_should_not_query_deleted_movies(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 2", year=2001, rating=9, genre_id=1))
+    session.commit()
+    token_response = client.post(
+        "/api/v1/token", data={"grant_type": "password", "username": "admin", "password": "secret"})
+    client.delete(
+        "/api/v1/movies/1", headers={"Authorization": f"Bearer {token_response.json()['access_token']}"})
+    response = client.get("/api/v1/movies/?q=movie")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"id": 2, "title": "Movie 2", "year": 2001, "rating": 9, "genre_id": 1},
+    ]
+
+
+def test_should_page_movies_with_cursor(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 2", year=2001, rating=None, genre_id=1))
+    session.add(models.Movie(title="Movie 3", year=2002, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 4", year=2003, rating=5, genre_id=1))
+    session.commit()
+    for sort, expected in (("id", [1, 2, 3, 4]), ("rating", [2, 4, 1, 3]), ("-rating", [3, 1, 4, 2]), ("-year", [4, 3, 2, 1])):
+        ids, cursor = [], None
+        while True:
+            url = f"/api/v1/movies/?sort={sort}&limit=2" + \
+                (f"&cursor={cursor}" if cursor else "")
+            response = client.get(url)
+            ids += [movie["id"] for movie in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        assert ids == expected
+
+
+def test_should_page_query_results_with_cursor(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Star Wars", year=1977, rating=9, genre_id=1))
+    session.add(models.Movie(title="Star Trek", year=1979, rating=6, genre_id=1))
+    session.add(models.Movie(title="Star Wars Again", year=1980, rating=8, genre_id=1))
+    session.commit()
+    first_page = client.get("/api/v1/movies/?q=star&limit=2")
+    assert [movie["id"] for movie in first_page.json()] == [1, 2]
+    second_page = client.get(
+        f"/api/v1/movies/?q=star&limit=2&cursor={first_page.headers['X-Next-Cursor']}")
+    assert [movie["id"] for movie in second_page.json()] == [3]
+    assert "X-Next-Cursor" not in second_page.headers
+
+
+def test_should_not_accept_cursor_from_another_sort(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 2", year=2001, rating=9, genre_id=1))
+    session.commit()
+    response = client.get("/api/v1/movies/?sort=year&limit=1")
+    response = client.get(
+        f"/api/v1/movies/?sort=rating&cursor={response.headers['X-Next-Cursor']}")
+    assert response.status_code == 400
+    assert client.get("/api/v1/movies/?sort=genre_id").status_code == 400
+
+    # a tampered key is refused before it reaches the query
+    for sort, key in [("year", [{"a": 1}, 1]), ("year", [2000, [1]]), ("title", [2000, 1]),
+                      ("title", [None, 1]), ("rating", ["8", 1]), ("id", [True, 1]), ("id", [1, 1.5])]:
+        response = client.get(f"/api/v1/movies/?sort={sort}&cursor={pagination.encode_cursor(sort, key)}")
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Invalid cursor"
+    cursor = pagination.encode_cursor("title", ["Movie 1", 1])
+    assert client.get(f"/api/v1/movies/?sort=title&cursor={cursor}").json()[0]["id"] == 2
+
+
+def test_should_import_movies_in_bulk(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Genre(name="Drama"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    token_response = client.post(
+        "/api/v1/token", data={"grant_type": "password", "username": "admin", "password": "secret"})
+    dump = "\n".join([
+        "primaryTitle\tstartYear\taverageRating\tgenres",
+        "Movie 1\t2000\t8\tAction",
+        "Movie 2\t2001\t\\N\tDrama,Action",
+        "Movie 2\t2001\t7\tDrama",
+        "Movie 3\tnot a year\t7\tDrama",
+        "Movie 4\t2004\t11\tDrama",
+        "Movie 5\t2005\t5\tWestern",
+    ])
+    response = client.post(
+        "/api/v1/movies/import?batch_size=2", files={"file": ("movies.tsv", dump)},
+        headers={"Authorization": f"Bearer {token_response.json()['access_token']}"})
+    assert response.status_code == 200
+    report = response.json()
+    assert report["inserted"] == 1
+    assert report["rejected"] == 5
+    assert [(rejection["line"], rejection["reason"]) for rejection in report["rejections"]] == [
+        (2, "Movie already added"),
+        (4, "Movie already added"),
+        (5, "year: value is not a valid integer"),
+        (6, "Rating must be between 0 and 10"),
+        (7, "genre_id: none is not an allowed value"),
+    ]
+    assert client.get("/api/v1/movies/2").json() == {
+        "id": 2, "title": "Movie 2", "year": 2001, "rating": None, "genre_id": 2}
+
+    headers = {"Authorization": f"Bearer {token_response.json()['access_token']}"}
+    for batch_size in (0, -1):
+        response = client.post(f"/api/v1/movies/import?batch_size={batch_size}",
+                               files={"file": ("movies.tsv", dump)}, headers=headers)
+        assert response.status_code == 422
+    response = client.post("/api/v1/movies/import", files={"file": ("movies.tsv", b"title\tyear\n\xff\t2000\n")},
+                           headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Malformed tsv file")
+
+
+def test_should_reject_movie_added_during_import(session):
+    session.add(models.Genre(name="Action"))
+    session.commit()
+    inserts = []
+
+    def add_same_movie(connection, cursor, statement, parameters, context, executemany):
+        # another writer adds the movie after the batch checked for it
+        if statement.startswith("INSERT INTO movies") and not inserts:
+            inserts.append(statement)
+            with engine.begin() as other:
+                other.execute(models.Movie.__table__.insert(), {
+                    "title": "Movie 2", "normalized_title": "movie 2", "year": 2001, "genre_id": 1, "is_active": True})
+
+    sa.event.listen(engine, "before_cursor_execute", add_same_movie)
+    try:
+        report = bulk_import.import_movies(session, [
+            (2, {"title": "Movie 1", "year": "2000", "genre_id": "1"}),
+            (3, {"title": "Movie 2", "year": "2001", "genre_id": "1"}),
+            (4, {"title": "Movie 3", "year": "2002", "genre_id": "1"}),
+        ])
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", add_same_movie)
+    assert (report.inserted, report.rejected) == (2, 1)
+    assert [(rejection.line, rejection.reason) for rejection in report.rejections] == [(3, "Movie already added")]
+    assert session.query(models.Movie).count() == 3
+
+
+def test_should_apply_batch_of_operations(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 2", year=2001, rating=9, genre_id=1))
+    session.commit()
+    token_response = client.post(
+        "/api/v1/token", data={"grant_type": "password", "username": "admin", "password": "secret"})
+    operations = [
+        {"op": "create", "movie": {"title": "Movie 3", "year": 2002, "rating": 7, "genre_id": 1}},
+        {"op": "create", "movie": {"title": "Movie 1", "year": 2000, "genre_id": 1}},
+        {"op": "update", "id": 1, "movie": {"title": "Movie 1b", "year": 2000, "rating": 5, "genre_id": 1}},
+        {"op": "patch", "id": 2, "movie": {"rating": 11}},
+        {"op": "patch", "id": 2, "movie": {"rating": 6}},
+        {"op": "delete", "id": 9},
+        {"op": "delete", "id": 1},
+    ]
+    response = client.post("/api/v1/movies:batch", json=operations, headers={
+        "Authorization": f"Bearer {token_response.json()['access_token']}"})
+    assert response.status_code == 200
+    assert response.json() == [
+        {"status": 201, "detail": None, "movie": {"id": 3, "title": "Movie 3", "year": 2002, "rating": 7, "genre_id": 1}},
+        {"status": 409, "detail": "Movie already added", "movie": None},
+        {"status": 200, "detail": None, "movie": {"id": 1, "title": "Movie 1b", "year": 2000, "rating": 5, "genre_id": 1}},
+        {"status": 400, "detail": "Rating must be between 0 and 10", "movie": None},
+        {"status": 200, "detail": None, "movie": {"id": 2, "title": "Movie 2", "year": 2001, "rating": 6, "genre_id": 1}},
+        {"status": 404, "detail": "Missing movie with id 9", "movie": None},
+        {"status": 200, "detail": None, "movie": {"id": 1, "title": "Movie 1b", "year": 2000, "rating": 5, "genre_id": 1}},
+    ]
+    assert [movie["id"] for movie in client.get("/api/v1/movies/").json()] == [2, 3]
+
+
+def test_should_answer_conflict_for_movie_added_during_batch(client, session):
+    session.add(models.Genre(name="Action"))
+    session.commit()
+    flushes = []
+
+    def add_same_movie(db, flush_context, instances):
+        # another request adds the movie after the batch checked for it
+        if not flushes:
+            with engine.begin() as connection:
+                connection.execute(models.Movie.__table__.insert(), {
+                    "title": "Movie 1", "normalized_title": "movie 1", "year": 2000, "genre_id": 1, "is_active": True})
+        flushes.append(db)
+
+    sa.event.listen(TestingSessionLocal, "before_flush", add_same_movie)
+    try:
+        response = client.post("/api/v1/movies:batch", json=[
+            {"op": "create", "movie": {"title": "Movie 1", "year": 2000, "genre_id": 1}},
+            {"op": "create", "movie": {"title": "Movie 2", "year": 2000, "genre_id": 1}},
+        ])
+    finally:
+        sa.event.remove(TestingSessionLocal, "before_flush", add_same_movie)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()] == [409, 201]
+    assert len(flushes) == 2
+
+
+def test_should_not_delete_in_batch_without_authentication(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    response = client.post("/api/v1/movies:batch",
+                           json=[{"op": "delete", "id": 1}])
+    assert response.status_code == 200
+    assert response.json() == [
+        {"status": 401, "detail": "Not authenticated", "movie": None}]
+    assert client.get("/api/v1/movies/1").status_code == 200
+
+
+def test_should_serve_movie_by_id_from_cache(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    assert client.get("/api/v1/movies/1").json()["title"] == "Movie 1"
+    misses = db_queries.movie_cache.misses
+    assert client.get("/api/v1/movies/1").json()["title"] == "Movie 1"
+    assert db_queries.movie_cache.misses == misses
+    client.patch("/api/v1/movies/1?title=Movie%202")
+    assert client.get("/api/v1/movies/1").json()["title"] == "Movie 2"
+    client.post("/api/v1/movies:batch",
+                json=[{"op": "patch", "id": 1, "movie": {"title": "Movie 3"}}])
+    assert client.get("/api/v1/movies/1").json()["title"] == "Movie 3"
+
+
+def test_cache_should_evict_least_recently_used_and_expired_entries():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    cache.get(1)
+    cache.set(3, "c")
+    assert cache.get(2) is None
+    assert cache.get(1) == "a"
+    cache.set(4, "d", ttl=-1)
+    assert cache.get(4) is None
+    generation = cache.generation
+    cache.invalidate(1)
+    cache.set(1, "stale", generation=generation)
+    assert cache.get(1) is None
+    assert cache.stats() == {"size": 0, "hits": 2, "misses": 3, "evictions": 2}
+
+
+def test_should_answer_not_modified_for_unchanged_movie(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    response = client.get("/api/v1/movies/1")
+    etag = response.headers["ETag"]
+    response = client.get("/api/v1/movies/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    client.patch("/api/v1/movies/1?rating=9")
+    response = client.get("/api/v1/movies/1", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["rating"] == 9
+
+
+def test_should_answer_not_modified_for_unchanged_collections(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    movies_etag = client.get("/api/v1/movies/").headers["ETag"]
+    genres_etag = client.get("/api/v1/genres/").headers["ETag"]
+    assert client.get("/api/v1/movies/", headers={"If-None-Match": movies_etag}).status_code == 304
+    assert client.get("/api/v1/genres/", headers={"If-None-Match": f"W/{genres_etag}"}).status_code == 304
+    client.post(
+        "/api/v1/movies/", json={"title": "Movie 2", "year": 2001, "rating": 8, "genre_id": 1})
+    response = client.get("/api/v1/movies/", headers={"If-None-Match": movies_etag})
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+
+
+def test_read_engine_should_reject_writes():
+    db = ReadSessionLocal()
+    try:
+        with pytest.raises(sa.exc.OperationalError, match="readonly"):
+            db.execute(sa.text("CREATE TABLE read_only_check (id INTEGER)"))
+    finally:
+        db.close()
+
+
+def test_should_report_pool_checkout_waits(client):
+    db = ReadSessionLocal()
+    db.execute(sa.text("SELECT 1"))
+    db.close()
+    assert client.get("/api/v1/db/pool").status_code == 401
+    token_response = client.post(
+        "/api/v1/token", data={"grant_type": "password", "username": "admin", "password": "secret"})
+    response = client.get("/api/v1/db/pool", headers={
+        "Authorization": f"Bearer {token_response.json()['access_token']}"})
+    assert response.status_code == 200
+    assert response.json()["read"]["checkouts"] >= 1
+    assert response.json()["read"]["max_wait_seconds"] >= 0
+
+
+def test_should_log_requests_with_redacted_headers_and_body(client):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    request_logger = logging.getLogger("api_logger.requests")
+    request_logger.addHandler(handler)
+    try:
+        client.post("/api/v1/token", data={"grant_type": "password", "username": "admin", "password": "secret"},
+                    headers={"Authorization": "Basic abc", "X-Trace": "1"})
+    finally:
+        request_logger.removeHandler(handler)
+    assert len(records) == 1
+    assert records[0].request["status"] == 200
+    entry = json.loads(JsonFormatter(
+        redact_headers=["authorization"], redact_body_fields=["password"]).format(records[0]))
+    assert entry["method"] == "POST"
+    assert entry["path"] == "/api/v1/token"
+    assert entry["headers"]["authorization"] == "***"
+    assert entry["headers"]["x-trace"] == "1"
+    assert entry["body"] == "grant_type=password&username=admin&password=***"
+
+    # fields are redacted in the parsed body and query, whatever their value holds
+    record = logging.makeLogRecord({"msg": "request", "request": {
+        "method": "POST", "path": "/", "query": "password=a%22b&q=1", "status": 200,
+        "headers": [(b"content-type", b"application/json")],
+        "body": b'{"password": "a\\"b", "users": [{"Password": "c, d"}], "name": "x"}'}})
+    entry = json.loads(JsonFormatter(redact_body_fields=["password"]).format(record))
+    assert entry["query"] == "password=***&q=1"
+    assert json.loads(entry["body"]) == {"password": "***", "users": [{"Password": "***"}], "name": "x"}
+    record.request["body"] = b'{"password": "a\\"b'
+    assert json.loads(JsonFormatter(redact_body_fields=["password"]).format(record))["body"] == "***"
+
+
+def test_should_cache_verified_tokens(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 2", year=2001, rating=9, genre_id=1))
+    session.commit()
+    token_response = client.post(
+        "/api/v1/token", data={"grant_type": "password", "username": "admin", "password": "secret"})
+    headers = {"Authorization": f"Bearer {token_response.json()['access_token']}"}
+    assert client.delete("/api/v1/movies/1", headers=headers).status_code == 200
+    hits = auth.token_cache.hits
+    assert client.delete("/api/v1/movies/2", headers=headers).status_code == 200
+    assert auth.token_cache.hits == hits + 1
+    assert client.delete("/api/v1/movies/2", headers={"Authorization": "Bearer invalid"}).status_code == 401
+
+
+def test_should_turn_away_logins_when_password_hashing_is_saturated(client):
+    for _ in range(auth.PASSWORD_HASH_MAX_PENDING):
+        auth.pending_password_hashes.acquire()
+    try:
+        response = client.post(
+            "/api/v1/token", data={"grant_type": "password", "username": "admin", "password": "secret"})
+    finally:
+        for _ in range(auth.PASSWORD_HASH_MAX_PENDING):
+            auth.pending_password_hashes.release()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_should_not_create_duplicate_movie(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="The Matrix", year=1999, rating=8, genre_id=1))
+    session.commit()
+    response = client.post(
+        "/api/v1/movies/", json={"title": "  the  MATRIX ", "year": 1999, "rating": 9, "genre_id": 1})
+    assert response.status_code == 409
+    assert response.json() == {"detail": "Movie already added"}
+    response = client.post(
+        "/api/v1/movies/", json={"title": "The Matrix", "year": 2003, "rating": 7, "genre_id": 1})
+    assert response.status_code == 201
+
+
+def test_should_upsert_movie(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="The Matrix", year=1999, rating=8, genre_id=1))
+    session.commit()
+    response = client.post(
+        "/api/v1/movies/?upsert=true", json={"title": "The matrix", "year": 1999, "rating": 9, "genre_id": 1})
+    assert response.status_code == 200
+    assert response.json() == {"id": 1, "title": "The matrix",
+                               "year": 1999, "rating": 9, "genre_id": 1}
+    response = client.post(
+        "/api/v1/movies/?upsert=true", json={"title": "Alien", "year": 1979, "rating": 8, "genre_id": 1})
+    assert response.status_code == 201
+    assert response.json()["id"] == 2
+
+
+def test_should_upsert_movie_deleted_meanwhile(client, session, monkeypatch):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Alien", year=1979, rating=8, genre_id=1))
+    session.commit()
+    get_movie_by_identity = db_queries.get_movie_by_identity
+
+    def delete_then_get(db, title, year):
+        # another request soft deletes the movie between the insert and the lookup
+        session.execute(sa.text("UPDATE movies SET is_active = 0 WHERE id = 1"))
+        session.commit()
+        return get_movie_by_identity(db, title, year)
+
+    monkeypatch.setattr(db_queries, "get_movie_by_identity", delete_then_get)
+    response = client.post(
+        "/api/v1/movies/?upsert=true", json={"title": "Alien", "year": 1979, "rating": 9, "genre_id": 1})
+    assert response.status_code == 201
+    assert response.json()["id"] == 2
+
+
+def test_should_recreate_deleted_movie(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="The Matrix", year=1999,
+                rating=8, genre_id=1, is_active=False))
+    session.commit()
+    response = client.post(
+        "/api/v1/movies/", json={"title": "The Matrix", "year": 1999, "rating": 8, "genre_id": 1})
+    assert response.status_code == 201
+    assert response.json()["id"] == 2
+
+
+def test_should_not_update_into_duplicate_movie(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="The Matrix", year=1999, rating=8, genre_id=1))
+    session.add(models.Movie(title="Alien", year=1979, rating=8, genre_id=1))
+    session.commit()
+    response = client.put(
+        "/api/v1/movies/2", json={"title": "the matrix", "year": 1999, "rating": 8, "genre_id": 1})
+    assert response.status_code == 409
+    response = client.patch("/api/v1/movies/2?title=THE%20MATRIX&year=1999")
+    assert response.status_code == 409
+    assert client.get("/api/v1/movies/2").json()["title"] == "Alien"
+
+
+def test_should_not_move_year_into_duplicate_movie_in_batch(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Alien", year=1979, rating=8, genre_id=1))
+    session.add(models.Movie(title="Alien", year=1986, rating=8, genre_id=1))
+    session.commit()
+    response = client.post("/api/v1/movies:batch", json=[
+        {"op": "patch", "id": 2, "movie": {"year": 1979}},
+        {"op": "patch", "id": 2, "movie": {"rating": 9}},
+    ])
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()] == [409, 200]
+    assert client.get("/api/v1/movies/2").json()["year"] == 1986
+
+
+def test_movie_stats_follow_writes(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Genre(name="Drama"))
+    session.commit()
+    for title, year, rating, genre_id in [("Movie 1", 2000, 8.5, 1), ("Movie 2", 2000, 6, 1),
+                                          ("Movie 3", 2001, None, 2), ("Movie 4", 2001, 10, 2)]:
+        client.post("/api/v1/movies/", json={"title": title, "year": year, "rating": rating, "genre_id": genre_id})
+    client.put("/api/v1/movies/2", json={"title": "Movie 2", "year": 2000, "rating": 7, "genre_id": 1})
+    client.patch("/api/v1/movies/3?genre_id=1")
+    movie = session.get(models.Movie, 4)
+    movie.is_active = False
+    session.commit()
+
+    response = client.get("/api/v1/stats/genres")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"key": 1, "count": 3, "rated": 2, "average_rating": 7.75,
+         "histogram": [0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0]},
+    ]
+    response = client.get("/api/v1/stats/years")
+    assert [(stat["key"], stat["count"]) for stat in response.json()] == [(2000, 2), (2001, 1)]
+    response = client.get("/api/v1/stats/years", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert client.get("/api/v1/stats/ratings").status_code == 404
+    assert db_queries.check_movie_stats(session) == []
+
+
+def test_movie_stats_rebuild(session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    session.execute(sa.text("UPDATE movie_stats SET count = 5"))
+    session.execute(sa.text(
+        "INSERT INTO movie_stats(genre_id, year, bucket, count, rating_sum) VALUES (1, 1999, 3, 1, 3)"))
+    session.commit()
+    assert db_queries.check_movie_stats(session) == [(1, 1999, 3), (1, 2000, 8)]
+    assert stats.main(["check", "--database-url", SQLALCHEMY_DATABASE_URL]) == 1
+    assert stats.main(["rebuild", "--database-url", SQLALCHEMY_DATABASE_URL]) == 0
+    assert db_queries.check_movie_stats(session) == []
+
+
+def test_filter_movies(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Genre(name="Drama"))
+    session.add(models.Movie(title="Movie 1", year=1995, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 2", year=1999, rating=6, genre_id=1))
+    session.add(models.Movie(title="Movie 3", year=1999, rating=None, genre_id=1))
+    session.add(models.Movie(title="Movie 4", year=2005, rating=9, genre_id=2))
+    session.add(models.Movie(title="Another", year=1998, rating=7, genre_id=1))
+    session.commit()
+
+    def ids(url):
+        return [movie["id"] for movie in client.get(url).json()]
+
+    assert ids("/api/v1/movies/?genre_id=1") == [1, 2, 3, 5]
+    assert ids("/api/v1/movies/?year_min=1996&year_max=2000") == [2, 3, 5]
+    assert ids("/api/v1/movies/?rating_min=7") == [1, 4, 5]
+    assert ids("/api/v1/movies/?rating_max=7") == [2, 5]
+    assert ids("/api/v1/movies/?genre_id=1&sort=-rating&limit=2") == [1, 5]
+    assert ids("/api/v1/movies/?sort=title&year_max=2000") == [5, 1, 2, 3]
+    assert ids("/api/v1/movies/?q=movie&genre_id=1&rating_min=7") == [1]
+    response = client.get("/api/v1/movies/?sort=-title&limit=2")
+    assert [movie["id"] for movie in response.json()] == [4, 3]
+    response = client.get(
+        f"/api/v1/movies/?sort=-title&limit=2&cursor={response.headers['X-Next-Cursor']}")
+    assert [movie["id"] for movie in response.json()] == [2, 1]
+
+
+def test_filters_and_sorts_use_an_index(session):
+    filters = {"genre_id": 1, "year_min": 1990, "year_max": 1999,
+               "rating_min": 5, "rating_max": 8}
+    for count in range(len(filters) + 1):
+        for names in itertools.combinations(filters, count):
+            for sort in ["id", "-id", "rating", "-rating", "year", "-year", "title", "-title"]:
+                query = db_queries.movies_query(session, sort, filters=schemas.MovieFilter(
+                    **{name: filters[name] for name in names})).limit(10)
+                compiled = query.statement.compile(dialect=engine.dialect)
+                plan = [row[3] for row in session.connection().exec_driver_sql(
+                    f"EXPLAIN QUERY PLAN {compiled}", tuple(compiled.params[name] for name in compiled.positiontup))]
+                # The index of the sort key (led by genre_id under a genre
+                # filter) returns rows in order, the index of a filtered
+                # column narrows them down. Scanning a partial index only
+                # reads active movies, but is only fine to walk the sort order.
+                key = sort.lstrip("-")
+                prefix = "ix_movies_active_genre_" if "genre_id" in names else "ix_movies_active_"
+                sort_index = {"id": prefix + "id", "title": None if "genre_id" in names else prefix + "title_id"}.get(
+                    key, f"{prefix}{key}_id")
+                expected = {sort_index} | {f"{prefix}{column}_id" for column in ("year", "rating")
+                                           if f"{column}_min" in names or f"{column}_max" in names}
+                if "genre_id" in names:
+                    expected |= {prefix + "id", prefix + "rating_id", prefix + "year_id"}
+                    assert plan[0].startswith("SEARCH") and "genre_id=?" in plan[0], (names, sort, plan)
+                step, index = re.match(r"(SEARCH|SCAN) movies USING INDEX (\w+)", plan[0]).groups()
+                assert index in expected, (names, sort, plan)
+                if step == "SCAN" or index == sort_index:
+                    assert index == sort_index and "USE TEMP B-TREE FOR ORDER BY" not in plan, (names, sort, plan)
+                assert not any(step.startswith("SCAN movies") for step in plan[1:]), (names, sort, plan)
+
+
+def test_search_facets(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Genre(name="Drama"))
+    session.add(models.Movie(title="Star Wars", year=1977, rating=8, genre_id=1))
+    session.add(models.Movie(title="Star Trek", year=1979, rating=6, genre_id=1))
+    session.add(models.Movie(title="A Star Is Born", year=2018, rating=7, genre_id=2))
+    session.add(models.Movie(title="Heat", year=1995, rating=8, genre_id=1))
+    session.commit()
+
+    response = client.get("/api/v1/movies/?q=star&limit=1&facets=genre,decade")
+    assert response.status_code == 200
+    assert len(response.json()["movies"]) == 1
+    assert response.json()["facets"] == {
+        "genre": [{"value": 1, "name": "Action", "count": 2}, {"value": 2, "name": "Drama", "count": 1}],
+        "decade": [{"value": 1970, "name": None, "count": 2}, {"value": 2010, "name": None, "count": 1}],
+    }
+    # without a search the counts come from the summary table
+    response = client.get("/api/v1/movies/?facets=decade&year_max=2000")
+    assert [movie["id"] for movie in response.json()["movies"]] == [1, 2, 4]
+    assert response.json()["facets"] == {
+        "decade": [{"value": 1970, "name": None, "count": 2}, {"value": 1990, "name": None, "count": 1}],
+    }
+    response = client.get("/api/v1/movies/?facets=genre&rating_min=7")
+    assert response.json()["facets"] == {
+        "genre": [{"value": 1, "name": "Action", "count": 2}, {"value": 2, "name": "Drama", "count": 1}],
+    }
+    assert client.get("/api/v1/movies/?facets=rating").status_code == 400
+
+
+def test_metrics(client, session):
+    def sample(text, name):
+        match = re.search(rf"^{re.escape(name)} (\S+)$", text, re.MULTILINE)
+        return float(match.group(1)) if match else 0
+
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    assert client.get("/metrics").status_code == 401
+    token_response = client.post(
+        "/api/v1/token", data={"grant_type": "password", "username": "admin", "password": "secret"})
+    headers = {"Authorization": f"Bearer {token_response.json()['access_token']}"}
+    before = client.get("/metrics", headers=headers).text
+    client.get("/api/v1/movies/1")
+    client.get("/api/v1/movies/2")
+    response = client.get("/metrics", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    after = response.text
+
+    route = 'method="GET",route="/api/v1/movies/{movie_id}"'
+    for name, increase in [
+            (f"http_request_duration_seconds_count{{{route}}}", 2),
+            (f'http_request_duration_seconds_bucket{{{route},le="+Inf"}}', 2),
+            (f'http_responses_total{{{route},status="200"}}', 1),
+            (f'http_responses_total{{{route},status="404"}}', 1),
+            ('db_query_duration_seconds_count{engine="test",query="get_movie_version"}', 2),
+            ('db_query_duration_seconds_count{engine="test",query="get_movie_by_id"}', 1)]:
+        assert sample(after, name) - sample(before, name) == increase, name
+    assert 'db_pool_checkouts{pool="write"}' in after
+    assert sample(after, 'cache_misses{cache="movies"}') > sample(before, 'cache_misses{cache="movies"}')
+
+
+def test_histogram_buckets():
+    histogram = metrics.Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 2.65
+
+
+def test_export_movies(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie, 2", year=2001, rating=None, genre_id=1))
+    session.add(models.Movie(title="Movie 3", year=2002, rating=7, genre_id=1, is_active=False))
+    session.commit()
+
+    response = client.get("/api/v1/movies/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [(row["id"], row["title"], row["rating"], row["is_active"]) for row in rows] == [
+        (1, "Movie 1", 8, True), (2, "Movie, 2", None, True)]
+    assert rows[0]["updated_at"]
+
+    response = client.get("/api/v1/movies/export?format=csv",
+                          headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    rows = list(csv.reader(response.text.splitlines()))
+    assert rows[0] == ["id", "title", "year", "rating", "genre_id", "is_active", "updated_at"]
+    assert [row[:4] for row in rows[1:]] == [["1", "Movie 1", "2000", "8"], ["2", "Movie, 2", "2001", ""]]
+    assert client.get("/api/v1/movies/export?format=xml").status_code == 400
+    response = client.get("/api/v1/movies/export", headers={"Accept-Encoding": "gzip;q=0, identity"})
+    assert "content-encoding" not in response.headers
+    assert len(response.text.splitlines()) == 2
+
+
+def test_accepts_gzip():
+    assert export.accepts_gzip("gzip")
+    assert export.accepts_gzip("deflate, GZIP;q=0.5")
+    assert export.accepts_gzip("br;q=1.0, *;q=0.1")
+    assert not export.accepts_gzip("")
+    assert not export.accepts_gzip("identity")
+    assert not export.accepts_gzip("gzip;q=0")
+    assert not export.accepts_gzip("gzip; q=0.000, *")
+    assert not export.accepts_gzip("*;q=0")
+    assert not export.accepts_gzip("gzip;q=abc")
+
+
+def test_export_movies_updated_since(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 2", year=2001, rating=6, genre_id=1))
+    session.add(models.Movie(title="Movie 3", year=2002, rating=7, genre_id=1))
+    session.commit()
+    time.sleep(0.01)
+    since = datetime.utcnow()
+    time.sleep(0.01)
+    client.patch("/api/v1/movies/3?rating=9")
+    session.get(models.Movie, 1).is_active = False
+    session.commit()
+
+    response = client.get(f"/api/v1/movies/export?updated_since={since.isoformat()}")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [(row["id"], row["rating"], row["is_active"]) for row in rows] == [
+        (3, 9, True), (1, 8, False)]
+
+
+def test_gzip_export_chunks():
+    chunks = list(export.gzip_chunks(iter([b"a" * 10, b"b" * 10])))
+    assert gzip.decompress(b"".join(chunks)) == b"a" * 10 + b"b" * 10
+
+
+def test_expand_genre(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Genre(name="Drama"))
+    for i in range(1, 7):
+        session.add(models.Movie(title=f"Movie {i}", year=2000 + i, rating=8, genre_id=i % 2 + 1))
+    session.commit()
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        # the change feed's checks are not part of the page
+        if "data_version" not in statement and "change_log" not in statement:
+            statements.append(statement)
+
+    sa.event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        client.get("/api/v1/movies/?limit=6")
+        plain = len(statements)
+        statements.clear()
+        response = client.get("/api/v1/movies/?limit=6&expand=genre")
+        assert len(statements) == plain + 1  # the genres and their version
+        statements.clear()
+        client.get("/api/v1/movies/?limit=6&expand=genre")
+        assert len(statements) == plain  # genres are cached now
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", count_statement)
+
+    assert [movie["genre"] for movie in response.json()[:2]] == [
+        {"id": 2, "name": "Drama"}, {"id": 1, "name": "Action"}]
+    response = client.get("/api/v1/movies/1?expand=genre")
+    assert response.json() == {"id": 1, "title": "Movie 1", "year": 2001, "rating": 8,
+                               "genre_id": 2, "genre": {"id": 2, "name": "Drama"}}
+    assert "genre" not in client.get("/api/v1/movies/1").json()
+    assert client.get("/api/v1/movies/1?expand=director").status_code == 400
+
+
+def test_trigram_index():
+    index = trigram.TrigramIndex()
+    index.add(1, "The Godfather")
+    index.add(2, "The Godfather Part II")
+    index.add(3, "Goodfellas")
+    assert [movie_id for movie_id, _ in index.search("godfater")] == [1, 2]
+    index.add(1, "The Matrix")
+    assert [movie_id for movie_id, _ in index.search("godfater")] == [2]
+    assert [movie_id for movie_id, _ in index.search("matrx")] == [1]
+    index.remove(2)
+    assert index.search("godfater") == []
+    assert index.stats()["titles"] == 2
+
+
+def test_trigram_search_is_bounded():
+    bounded, exhaustive = trigram.TrigramIndex(max_counted_postings=5, max_candidates=3), \
+        trigram.TrigramIndex(max_counted_postings=None, max_candidates=None)
+    for index in (bounded, exhaustive):
+        for movie_id in range(1, 21):
+            index.add(movie_id, f"The Night {movie_id}")
+        index.add(21, "Spider-Man: The Night")
+    # found through its rare trigrams, with the exact similarity
+    assert bounded.search("spidr man night", limit=1) == exhaustive.search("spidr man night", limit=1)
+    assert bounded.search("spidr man night", limit=1)[0][0] == 21
+    # only common trigrams: at most max_candidates titles are scored
+    assert len(exhaustive.search("the night")) == 21
+    assert len(bounded.search("the night")) == 3
+
+
+def test_fuzzy_search(client, session, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_PUBLIC", True)
+    session.add(models.Genre(name="Action"))
+    session.add(models.Genre(name="Drama"))
+    session.add(models.Movie(title="The Godfather", year=1972, rating=9, genre_id=2))
+    session.add(models.Movie(title="Star Wars", year=1977, rating=8, genre_id=1))
+    session.add(models.Movie(title="Star Trek", year=1979, rating=6, genre_id=1))
+    session.commit()
+
+    response = client.get("/api/v1/movies/?q=Godfater&fuzzy=true")
+    assert [movie["title"] for movie in response.json()] == ["The Godfather"]
+    assert client.get("/api/v1/movies/?q=Godfater").status_code == 404
+    response = client.get("/api/v1/movies/?q=Star Wras&fuzzy=true")
+    assert [movie["title"] for movie in response.json()] == ["Star Wars", "Star Trek"]
+    response = client.get("/api/v1/movies/?q=Star Wras&fuzzy=true&rating_max=7")
+    assert [movie["title"] for movie in response.json()] == ["Star Trek"]
+    assert "X-Next-Cursor" not in client.get("/api/v1/movies/?q=Star&fuzzy=true&limit=1").headers
+
+    # writes reach the index on the next search
+    client.put("/api/v1/movies/2", json={"title": "Empire Strikes Back", "year": 1980, "rating": 8, "genre_id": 1})
+    session.get(models.Movie, 1).is_active = False
+    session.add(models.Movie(title="The Godfather Part II", year=1974, rating=9, genre_id=2))
+    session.commit()
+    response = client.get("/api/v1/movies/?q=Star Wras&fuzzy=true")
+    assert [movie["title"] for movie in response.json()] == ["Star Trek"]
+    assert client.get("/api/v1/movies/?q=Empire Stirkes&fuzzy=true").json()[0]["id"] == 2
+    response = client.get("/api/v1/movies/?q=Godfater&fuzzy=true")
+    assert [movie["title"] for movie in response.json()] == ["The Godfather Part II"]
+    assert 'index_titles{index="title_trigrams"} 3' in client.get("/metrics").text
+
+    assert client.get("/api/v1/movies/?fuzzy=true").status_code == 400
+    assert client.get("/api/v1/movies/?q=Star&fuzzy=true&sort=year").status_code == 400
+
+
+def test_title_indexes_catch_up_one_thread_at_a_time(session, monkeypatch):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    db_queries.sync_title_trigrams(session)
+    session.get(models.Movie, 1).title = "Movie 2"
+    session.commit()
+    running, overlaps = [], []
+    add = db_queries.title_trigrams.add
+
+    def slow_add(*args):
+        overlaps.append(len(running))
+        running.append(args)
+        time.sleep(0.05)
+        add(*args)
+        running.pop()
+
+    def sync():
+        db = TestingSessionLocal()
+        try:
+            db_queries.sync_title_trigrams(db)
+        finally:
+            db.close()
+
+    monkeypatch.setattr(db_queries.title_trigrams, "add", slow_add)
+    threads = [threading.Thread(target=sync) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [0, 0]
+    assert [movie_id for movie_id, _ in db_queries.title_trigrams.search("movie 2", None, 0.9)] == [1]
+
+
+def test_suggest_index(monkeypatch):
+    monkeypatch.setattr(suggest, "CACHED_RANGE", 2)
+    index = suggest.SuggestIndex(limit=2)
+    index.build([(1, "Star Wars", 1977, 8.6), (2, "Star Trek", 1979, 6.4),
+                 (3, "Stargate", 1994, 7.1), (4, "Alien", 1979, None)])
+    assert [movie_id for movie_id, *_ in index.suggest("st")] == [1, 3]
+    assert index.suggest("star w") == [(1, "Star Wars", 1977, 8.6)]
+    assert index.suggest("ALI") == [(4, "Alien", 1979, None)]
+    index.add(5, "Stardust", 2007, 7.6)
+    assert [movie_id for movie_id, *_ in index.suggest("sta", limit=1)] == [1]
+    index.remove(1)
+    index.remove(5)
+    index.add(2, "Star Trek", 1979, 9)
+    assert [movie_id for movie_id, *_ in index.suggest("star")] == [2, 3]
+    assert index.suggest("x") == []
+
+    # a low ranked title added to a cached list shrunk by removals
+    index.build([(movie_id, f"A{movie_id}", 2000, 9 - movie_id) for movie_id in range(1, 9)])
+    index.remove(1)
+    index.add(11, "A11", 2000, 0.5)
+    index.remove(2)
+    index.remove(3)
+    assert [movie_id for movie_id, *_ in index.suggest("a")] == [4, 5]
+
+
+def test_suggest_movies(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Star Wars", year=1977, rating=8.6, genre_id=1))
+    session.add(models.Movie(title="Star Trek", year=1979, rating=6.4, genre_id=1))
+    session.add(models.Movie(title="Stargate", year=1994, rating=7.1, genre_id=1))
+    session.commit()
+
+    response = client.get("/api/v1/movies/suggest?prefix=Sta")
+    assert response.status_code == 200
+    assert [movie["title"] for movie in response.json()] == ["Star Wars", "Stargate", "Star Trek"]
+    assert response.json()[0] == {"id": 1, "title": "Star Wars", "year": 1977, "rating": 8.6}
+    assert [movie["id"] for movie in client.get("/api/v1/movies/suggest?prefix=star&limit=1").json()] == [1]
+    assert client.get("/api/v1/movies/suggest?prefix=Godf").json() == []
+
+    client.patch("/api/v1/movies/2?rating=9")
+    session.get(models.Movie, 1).is_active = False
+    session.add(models.Movie(title="The Godfather", year=1972, rating=9.2, genre_id=1))
+    session.commit()
+    response = client.get("/api/v1/movies/suggest?prefix=star")
+    assert [movie["title"] for movie in response.json()] == ["Star Trek", "Stargate"]
+    assert client.get("/api/v1/movies/suggest?prefix=the g").json()[0]["title"] == "The Godfather"
+    assert client.get("/api/v1/movies/suggest?prefix=star&limit=0").status_code == 400
+
+
+def test_archive_deleted_movies(session):
+    session.add(models.Genre(name="Action"))
+    for i in range(1, 6):
+        session.add(models.Movie(title=f"Movie {i}", year=2000 + i, rating=8, genre_id=1))
+    session.commit()
+    for movie_id in (1, 2, 3, 5):
+        session.get(models.Movie, movie_id).is_active = False
+    session.commit()
+    session.execute(sa.text(
+        "UPDATE movies SET updated_at = '2000-01-01 00:00:00.000000' WHERE id IN (1, 2, 5)"))
+    session.commit()
+
+    # movie 3 was deleted too recently and 5 has the highest id
+    assert compact.compact(session, retention_days=30, batch_size=1, pause=0) == (2, None)
+    assert [movie.id for movie in session.query(models.ArchivedMovie).order_by(models.ArchivedMovie.id)] == [1, 2]
+    assert session.get(models.ArchivedMovie, 1).title == "Movie 1"
+    assert [movie_id for movie_id, in session.query(models.Movie.id).order_by(models.Movie.id)] == [3, 4, 5]
+    assert db_queries.check_movie_stats(session) == []
+    assert compact.compact(session, retention_days=30, pause=0) == (0, None)
+
+
+def test_coalescing_middleware():
+    calls = []
+
+    async def endpoint(scope, receive, send):
+        calls.append(scope["query_string"])
+        await asyncio.sleep(0.05)
+        if scope["query_string"] == b"fail" and len(calls) == 1:
+            raise RuntimeError("leader failed")
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": scope["query_string"]})
+
+    async def get(middleware, path, query_string=b""):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": path, "root_path": "",
+                 "query_string": query_string, "headers": []}
+        try:
+            await middleware(scope, None, send)
+        except RuntimeError:
+            return None
+        return messages[-1]["body"]
+
+    def run(middleware, *requests):
+        async def main():
+            return await asyncio.gather(*(get(middleware, *request) for request in requests))
+        return asyncio.run(main())
+
+    def count(outcome):
+        return metrics.coalesced_requests.child("/api/v1/movies/", outcome).value
+
+    middleware = coalesce.CoalescingMiddleware(endpoint, app.router, COALESCED_PATHS)
+    shared = count("shared")
+    # parameters in another order are the same request, other routes are not coalesced
+    assert run(middleware, *[("/api/v1/movies/", b"q=star&limit=5")] * 5, ("/api/v1/movies/", b"limit=5&q=star"),
+               ("/api/v1/movies/", b"q=heat"), ("/api/v1/movies/export", b"")) == [b"q=star&limit=5"] * 5 + [
+        b"q=star&limit=5", b"q=heat", b""]
+    assert len(calls) == 3
+    assert count("shared") - shared == 5
+
+    # when the leader fails one follower runs the query for the others
+    calls.clear()
+    assert run(middleware, *[("/api/v1/movies/", b"fail")] * 4) == [None] + [b"fail"] * 3
+    assert len(calls) == 2
+
+    # followers run themselves after the bounded wait
+    calls.clear()
+    middleware = coalesce.CoalescingMiddleware(endpoint, app.router, COALESCED_PATHS, max_wait=0.01)
+    timeouts = count("timeout")
+    assert run(middleware, *[("/api/v1/movies/", b"q=star")] * 3) == [b"q=star"] * 3
+    assert len(calls) == 3
+    assert count("timeout") - timeouts == 2
+
+
+def test_caches_follow_writes_of_other_workers(client, session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    assert client.get("/api/v1/movies/1").json()["rating"] == 8
+    assert client.get("/api/v1/genres/").json()[0]["name"] == "Action"
+
+    # another worker writes to the database, nothing in this process is told
+    session.execute(sa.text("UPDATE movies SET rating = 5 WHERE id = 1"))
+    session.execute(sa.text("UPDATE genres SET name = 'Drama' WHERE id = 1"))
+    session.commit()
+    assert client.get("/api/v1/movies/1").json()["rating"] == 5
+    assert client.get("/api/v1/genres/").json()[0]["name"] == "Drama"
+    assert session.query(models.ChangeLog.table_name, models.ChangeLog.row_id).all() == [
+        ("genres", 1), ("movies", 1), ("genres", 1)]
+
+    # changes pruned before this worker read them clear its caches
+    session.execute(sa.text("UPDATE movies SET rating = 6 WHERE id = 1"))
+    session.execute(sa.text("UPDATE genres SET name = 'Action' WHERE id = 1"))
+    session.commit()
+    changes.prune_change_log(session, keep=0)
+    assert session.query(models.ChangeLog).count() == 1
+    assert client.get("/api/v1/movies/1").json()["rating"] == 6
+    assert client.get("/api/v1/genres/").json()[0]["name"] == "Action"
+
+
+def test_change_log_is_trimmed_without_archiving(session):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.commit()
+    for rating in range(5):
+        session.execute(sa.text("UPDATE movies SET rating = :rating WHERE id = 1"), {"rating": rating})
+    session.commit()
+    ids = session.query(models.ChangeLog.id).order_by(models.ChangeLog.id).all()
+    assert len(ids) == 6
+    session.commit()
+
+    async def trimmed():
+        task = asyncio.ensure_future(compact.prune_change_log_periodically(TestingSessionLocal, interval=0.01, keep=2))
+        try:
+            while session.query(models.ChangeLog).count() > 2:
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+
+    asyncio.run(asyncio.wait_for(trimmed(), 5))
+    assert session.query(models.ChangeLog.id).order_by(models.ChangeLog.id).all() == ids[-2:]
+
+
+def test_group_commit(client, session, monkeypatch):
+    session.add(models.Genre(name="Action"))
+    session.add(models.Movie(title="Movie 1", year=2000, rating=8, genre_id=1))
+    session.add(models.Movie(title="Movie 2", year=2000, rating=8, genre_id=1))
+    session.commit()
+    writer = group_commit.GroupCommitWriter(TestingAsyncSessionLocal, max_delay=0.01)
+    monkeypatch.setattr("sql_app.main.movie_writer", writer)
+    response = client.patch("/api/v1/movies/1?rating=9")
+    assert response.status_code == 200
+    assert response.json()["rating"] == 9
+    assert client.get("/api/v1/movies/1").json()["rating"] == 9
+    assert client.patch("/api/v1/movies/3?rating=9").status_code == 404
+    assert client.patch("/api/v1/movies/2?title=Movie 1").status_code == 409
+    assert client.patch("/api/v1/movies/1?rating=11").status_code == 400
+
+    # concurrent patches share one commit and each gets its own result
+    commits = []
+
+    def count_commit(connection):
+        commits.append(connection)
+
+    def patch(movie_id, rating):
+        return writer.submit(schemas.MovieBatchOperation(
+            op="patch", id=movie_id, movie=schemas.MoviePatch(rating=rating)))
+
+    async def patch_all(writer):
+        return await asyncio.gather(patch(1, 7), patch(2, 6), patch(3, 5))
+
+    sa.event.listen(async_engine.sync_engine, "commit", count_commit)
+    try:
+        results = asyncio.run(patch_all(writer))
+    finally:
+        sa.event.remove(async_engine.sync_engine, "commit", count_commit)
+    assert [result.status for result in results] == [200, 200, 404]
+    assert len(commits) == 1
+    assert client.get("/api/v1/movies/2").json()["rating"] == 6
+
+    # a patch colliding on year fails alone
+    async def move_years():
+        return await asyncio.gather(*(writer.submit(schemas.MovieBatchOperation(
+            op="patch", id=movie_id, movie=schemas.MoviePatch(title="Movie 1", year=year)))
+            for movie_id, year in ((2, 2000), (1, 2001))))
+
+    assert [result.status for result in asyncio.run(move_years())] == [409, 200]
+    assert client.patch("/api/v1/movies/2?title=Movie%201&year=2001").status_code == 409
+    assert client.get("/api/v1/movies/2").json()["title"] == "Movie 2"
+
+    # a full batch does not wait for the delay
+    writer = group_commit.GroupCommitWriter(TestingAsyncSessionLocal, max_delay=10, max_batch=3)
+    start = time.perf_counter()
+    assert [result.status for result in asyncio.run(patch_all(writer))] == [200, 200, 404]
+    assert time.perf_counter() - start < 5
+    assert writer.batches == 1
+
+    # a cancelled request does not keep the rest of its batch waiting
+    async def cancel_one():
+        waiters = [asyncio.ensure_future(patch(movie_id, 4)) for movie_id in (1, 2)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        return await asyncio.wait_for(waiters[1], 5)
+
+    writer = group_commit.GroupCommitWriter(TestingAsyncSessionLocal, max_delay=0.01)
+    assert asyncio.run(cancel_one()).status == 200
+    assert writer.batches == 1
+
+
+def test_should_upgrade_database_of_first_release(tmp_path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        for statement in [
+            "CREATE TABLE genres (id INTEGER NOT NULL, name VARCHAR(20), is_active BOOLEAN NOT NULL, PRIMARY KEY (id))",
+            """CREATE TABLE movies (id INTEGER NOT NULL, title VARCHAR(20), rating NUMERIC(1, 2), year INTEGER,
+            is_active BOOLEAN NOT NULL, genre_id INTEGER, PRIMARY KEY (id), FOREIGN KEY(genre_id) REFERENCES genres (id))""",
+            "CREATE INDEX ix_movies_rating ON movies (rating)",
+            "INSERT INTO genres (name, is_active) VALUES ('Action', 1)",
+            """INSERT INTO movies (title, year, rating, is_active, genre_id) VALUES
+            ('Alien', 1979, 8, 1, 1), ('ALIEN ', 1979, 7, 1, 1), ('Heat', 1995, 8, 0, 1)""",
+        ]:
+            connection.exec_driver_sql(statement)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        with pytest.raises(db_queries.SchemaUpgradeError, match=r"'alien' 1979 \(ids 1, 2\)"):
+            db_queries.ensure_movie_columns(db)
+        db.execute(sa.text("UPDATE movies SET is_active = 0 WHERE id = 2"))
+        db.commit()
+        db_queries.ensure_movie_columns(db)
+        # every startup runs it again
+        db_queries.ensure_movie_columns(db)
+        db_queries.ensure_version_tracking(db)
+        db_queries.ensure_change_log(db)
+        db_queries.ensure_movie_stats(db)
+
+        movies = db.query(models.Movie).order_by(models.Movie.id).all()
+        assert [(movie.normalized_title, movie.version) for movie in movies] == [("alien", 1), ("alien", 1), ("heat", 1)]
+        assert all(movie.updated_at.year > 1970 for movie in movies)
+        indexes = {name for name, in db.execute(sa.text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+        assert "ix_movies_rating" not in indexes
+        assert {index.name for index in models.Movie.__table__.indexes} <= indexes
+
+        assert db_queries.create_movie(db, schemas.MovieBase(title="alien", year=1979, rating=5, genre_id=1)) is None
+        db_movie = db_queries.create_movie(db, schemas.MovieBase(title="Heat", year=1995, rating=8, genre_id=1))
+        assert db_movie.updated_at.year > 1970
+        db_queries.update_movie_partial(db, 1, schemas.MovieBase(title="Alien", year=1979, rating=9, genre_id=1))
+        db.refresh(movies[0])
+        assert movies[0].version == 2
+    finally:
+        db.close()
+        engine.dispose()
+
+
 print("All tests passed")